@@ -2,7 +2,20 @@
 # Copyright (c) 2016, Semilimes
 # For license information, please see license.txt
 
+import hmac
+import time
+import base64
+import hashlib
+from email.utils import getaddresses
+
 import frappe
+from frappe.utils import now
+
+from . import metrics, smtpapi
+from .lru import LRUCache
+from .sendgrid_integration.doctype.sendgrid_event.sendgrid_event import insert_events
+from .sendgrid_integration.doctype.sendgrid_recipient.sendgrid_recipient import (
+    set_recipient_statuses, count_recipients)
 
 
 UNSUBSCRIBE_LABELS = ("spam_report",
@@ -21,57 +34,428 @@ EVENT_TYPES = {"delivered": "Sent",
                "dropped": "Rejected",
                }
 
+# delivery status of communication can only be replaced by status of the same or
+# higher rank, so late or out of order events don't move communication back
+STATUS_PRECEDENCE = {"Delayed": 1,
+                     "Sent": 2,
+                     "Opened": 3,
+                     "Read": 3,
+                     "Clicked": 4,
+                     "Rejected": 5,
+                     "Bounced": 5,
+                     "Recipient Unsubscribed": 6,
+                     "Marked As Spam": 7,
+                     }
+
+# statuses of this rank concern one recipient, communication with many recipients gets
+# such status only when every recipient has one
+RECIPIENT_STATUS_RANK = 5
+
+# fields of Communication needed to apply webhook events
+COMMUNICATION_FIELDS = ["name", "recipients", "cc", "delivery_status"]
+
+# number of webhook events applied in one transaction
+WEBHOOK_BATCH_SIZE = 500
+
+# number of Email Unsubscribe records inserted at once
+UNSUBSCRIBE_CHUNK_SIZE = 1000
+
+# seconds webhook credentials index is kept in process, and minimal age of the index
+# before it is reloaded because of unknown credentials
+CREDENTIALS_INDEX_TTL = 60
+CREDENTIALS_INDEX_MIN_AGE = 5
+
+# communications cached by worker process, can be overridden in site config
+COMMUNICATION_CACHE_SIZE = 10000
+# seconds communication is cached, late opens and clicks arrive for hours
+COMMUNICATION_CACHE_TTL = 6 * 60 * 60
+
+# loading time and index of webhook credentials by site
+_credentials_indexes = dict()
+
+# cache of communications by site
+_communication_caches = dict()
 
-def set_status(event_type, email, message_id):
+
+def set_status(event_type, email, message_id, timestamp=None, sg_event_id=None,
+               email_account=None):
     """
     Find the communication using message id and set delivery status.
 
+    Event is applied and committed as a batch of one event, see `set_statuses`.
+
     :param event_type: SendGrid event type received from webhook request
     :param email: email address received from webhook request
     :param message_id: unuque message id received from webhook request
+    :param timestamp: unix timestamp of event received from webhook request
+    :param sg_event_id: unique event id received from webhook request
+    :param email_account: Email Account the webhook request was authenticated for
+    """
+    set_statuses([{"event": event_type,
+                   "email": email,
+                   "message_id": message_id,
+                   "timestamp": timestamp,
+                   "sg_event_id": sg_event_id}],
+                 batch_size=1, email_account=email_account)
+
+
+def set_statuses(events, batch_size=WEBHOOK_BATCH_SIZE, email_account=None,
+                 after_commit=None):
     """
-    communication = get_communication(message_id)
+    Set delivery statuses for a list of webhook events in bulk.
 
-    if communication:
+    Events are applied in bounded batches, every batch is a single transaction with one
+    UPDATE per delivery status and one INSERT of Email Unsubscribe records. Events are
+    appended to SendGrid Event when `sendgrid_store_events` is set in site config.
+
+    Delivery status of every recipient of communications with many recipients is kept
+    in SendGrid Recipient, see `coalesce_recipient_events`.
+
+    :param events: list of SendGrid events received from webhook request
+    :param batch_size: maximum number of events to apply in one transaction
+    :param email_account: Email Account the webhook request was authenticated for
+    :param after_commit: function called with events of every committed batch
+    """
+    for batch in chunked(events, batch_size):
+        _set_statuses(batch, email_account)
+        with metrics.stage("commit"):
+            frappe.db.commit()
+        if after_commit:
+            after_commit(batch)
+
+
+def _set_statuses(events, email_account=None):
+    """
+    Apply one batch of webhook events without committing.
+
+    :param events: list of SendGrid events received from webhook request
+    :param email_account: Email Account the webhook request was authenticated for
+    """
+    with metrics.stage("lookup"):
+        communications = get_communications(event.get("message_id") for event in events)
+
+    delivery_statuses = coalesce_events(events, communications)
+    recipient_statuses = coalesce_recipient_events(events, communications)
+    unsubscribed_emails = set()
+    store_events = frappe.conf.sendgrid_store_events
+    stored_events = list()
+
+    for event in events:
+        email = event.get("email")
+        communication = communications.get(event.get("message_id"))
 
         # delivery status should be set as per the original recipient of communication
-        if email in communication.recipients:
-            set_delivery_status_and_commit(communication, event_type)
+        if not communication or not is_recipient(email, communication):
+            continue
+
+        if event.get("event") in UNSUBSCRIBE_LABELS:
+            unsubscribed_emails.add(email)
+
+        if store_events:
+            stored_events.append({"communication": communication.name,
+                                  "email": email,
+                                  "event": event.get("event"),
+                                  "event_time": event.get("timestamp"),
+                                  "email_account": email_account,
+                                  "sg_event_id": event.get("sg_event_id")})
+
+    communications_by_status = dict()
+    for communication_name, delivery_status in delivery_statuses.items():
+        communications_by_status.setdefault(delivery_status, []).append(
+            communication_name)
+
+    with metrics.stage("write"):
+        recipients_by_status = dict()
+        for recipient, delivery_status in recipient_statuses.items():
+            recipients_by_status.setdefault(delivery_status, []).append(recipient)
+
+        for delivery_status, recipients in recipients_by_status.items():
+            set_recipient_statuses(recipients, delivery_status,
+                                   get_higher_statuses(delivery_status) or [""])
 
-            if event_type in UNSUBSCRIBE_LABELS:
-                global_unsubscribe_and_commit(email)
+        for communication_name, delivery_status in get_failed_communications(
+                recipient_statuses, communications).items():
+            communications_by_status.setdefault(delivery_status, []).append(
+                communication_name)
 
+        for delivery_status, communication_names in communications_by_status.items():
+            set_delivery_status(communication_names, delivery_status)
 
-def get_communication(message_id):
+        global_unsubscribe(unsubscribed_emails, imported=True)
+        insert_events(stored_events)
+
+
+def coalesce_events(events, communications):
     """
-    Extract message id from metadata and return communication doc.
+    Collapse events to one final delivery status per communication.
 
-    :param message_id: unuque message id received from webhook request
+    Status of the highest rank in `STATUS_PRECEDENCE` wins, of equally ranked statuses
+    the one with later event timestamp wins. Communications that already have the final
+    status or a status of higher rank are left out. Statuses of `RECIPIENT_STATUS_RANK`
+    are skipped for communications with many recipients, see `get_failed_communications`.
+
+    Returns dict of communication name and delivery status to set.
+
+    :param events: list of SendGrid events received from webhook request
+    :param communications: communications by message id, see `get_communications`
     """
-    if message_id and "@{site}".format(site=frappe.local.site) in message_id:
-        communication_name = message_id.strip(" <>").split("@", 1)[0]
-        return frappe.get_doc("Communication", communication_name)
+    final_statuses = dict()
+
+    for event in events:
+        delivery_status = EVENT_TYPES.get(event.get("event"))
+        communication = communications.get(event.get("message_id"))
+
+        # delivery status should be set as per the original recipient of communication
+        if (not delivery_status or not communication or
+                not is_recipient(event.get("email"), communication)):
+            continue
 
+        order = (STATUS_PRECEDENCE.get(delivery_status, 0), event.get("timestamp") or 0)
+        if order[0] >= RECIPIENT_STATUS_RANK and len(communication.recipients) > 1:
+            continue
 
-def set_delivery_status_and_commit(communication, event_type):
+        final_status = final_statuses.get(communication.name)
+        if not final_status or order >= final_status[0]:
+            final_statuses[communication.name] = (order, delivery_status,
+                                                  communication.delivery_status)
+
+    delivery_statuses = dict()
+    for communication_name, final_status in final_statuses.items():
+        (rank, timestamp), delivery_status, current_status = final_status
+        if (delivery_status != current_status and
+                rank >= STATUS_PRECEDENCE.get(current_status, 0)):
+            delivery_statuses[communication_name] = delivery_status
+
+    return delivery_statuses
+
+
+def coalesce_recipient_events(events, communications):
     """
-    Evaluate event type and set the delivery status of the communication.
+    Collapse events to one final delivery status per recipient of communications with
+    many recipients.
 
-    :param communication: Frappe Communication DocType
-    :param event_type: SendGrid event type received from webhook request
+    Returns dict of Communication name and normalized email pair and delivery status to
+    set, statuses of higher rank set already are kept by `set_recipient_statuses`.
+
+    :param events: list of SendGrid events received from webhook request
+    :param communications: communications by message id, see `get_communications`
+    """
+    final_statuses = dict()
+
+    for event in events:
+        delivery_status = EVENT_TYPES.get(event.get("event"))
+        communication = communications.get(event.get("message_id"))
+
+        if (not delivery_status or not communication or
+                len(communication.recipients) < 2 or
+                not is_recipient(event.get("email"), communication)):
+            continue
+
+        recipient = (communication.name, normalize_email(event.get("email")))
+        order = (STATUS_PRECEDENCE.get(delivery_status, 0), event.get("timestamp") or 0)
+        if recipient not in final_statuses or order >= final_statuses[recipient][0]:
+            final_statuses[recipient] = (order, delivery_status)
+
+    return dict((recipient, delivery_status)
+                for recipient, (order, delivery_status) in final_statuses.items())
+
+
+def get_failed_communications(recipient_statuses, communications):
+    """
+    Get communications with many recipients every one of which has a status of
+    `RECIPIENT_STATUS_RANK`, e.g. bounced.
+
+    Returns dict of Communication name and the highest of these statuses set by the
+    batch. Should be called after recipient statuses are set.
+
+    :param recipient_statuses: statuses set by the batch, see `coalesce_recipient_events`
+    :param communications: communications by message id, see `get_communications`
     """
-    delivery_status = EVENT_TYPES.get(event_type)
+    failed_statuses = dict()
+    for (communication_name, email), delivery_status in recipient_statuses.items():
+        rank = STATUS_PRECEDENCE.get(delivery_status, 0)
+        if rank >= RECIPIENT_STATUS_RANK and rank > STATUS_PRECEDENCE.get(
+                failed_statuses.get(communication_name), 0):
+            failed_statuses[communication_name] = delivery_status
+
+    if not failed_statuses:
+        return dict()
+
+    counts = count_recipients(list(failed_statuses), [
+        status for status, rank in STATUS_PRECEDENCE.items()
+        if rank >= RECIPIENT_STATUS_RANK])
+
+    communications = dict((communication.name, communication)
+                          for communication in communications.values())
+    return dict((communication_name, delivery_status)
+                for communication_name, delivery_status in failed_statuses.items()
+                if counts.get(communication_name, 0) >=
+                len(communications[communication_name].recipients) and
+                delivery_status != communications[communication_name].delivery_status)
+
+
+def get_higher_statuses(delivery_status):
+    """
+    Get delivery statuses of higher rank than the given one.
+
+    :param delivery_status: delivery status to compare with
+    """
+    rank = STATUS_PRECEDENCE.get(delivery_status, 0)
+    return [status for status, status_rank in STATUS_PRECEDENCE.items()
+            if status_rank > rank]
+
+
+def set_delivery_status(communication_names, delivery_status):
+    """
+    Set the same delivery status for many communications with one query.
+
+    :param communication_names: names of Communication documents to update
+    :param delivery_status: delivery status to set
+    """
+    if not communication_names:
+        return
+
+    # status could be raised by another request since communications were fetched
+    higher_statuses = get_higher_statuses(delivery_status) or [""]
+
+    frappe.db.sql("""update `tabCommunication`
+        set delivery_status=%s, modified=%s, modified_by=%s
+        where name in ({0}) and ifnull(delivery_status, '') not in ({1})""".format(
+        ", ".join(["%s"] * len(communication_names)),
+        ", ".join(["%s"] * len(higher_statuses))),
+        [delivery_status, now(), frappe.session.user] + list(communication_names) +
+        higher_statuses)
+
+    get_communication_cache().invalidate(communication_names)
+
+
+def get_communications(message_ids):
+    """
+    Get communications for many message ids with one query.
+
+    Returns dict of message id and compact communication, see `get_communication_entry`.
+    Every communication is fetched once and shared between its message ids, cached
+    communications are not fetched. Message ids of other sites and unknown
+    communications are left out.
+
+    :param message_ids: unique message ids received from webhook request
+    """
+    communication_names = dict()
+    for message_id in set(message_ids):
+        communication_name = get_communication_name(message_id)
+        if communication_name:
+            communication_names[message_id] = communication_name
+
+    if not communication_names:
+        return dict()
 
-    if delivery_status:
-        communication.db_set("delivery_status", delivery_status)
-        frappe.db.commit()
+    cache = get_communication_cache()
+    communications = cache.get_many(set(communication_names.values()))
+    missing_names = set(communication_names.values()) - set(communications)
+    hits = len(set(communication_names.values())) - len(missing_names)
+    metrics.incr("sendgrid_communication_cache_hits_total", hits)
+    metrics.incr("sendgrid_communication_cache_misses_total", len(missing_names))
+
+    if missing_names:
+        for communication in frappe.get_all("Communication",
+                                            fields=get_communication_fields(),
+                                            filters={"name": ("in", list(missing_names))}):
+            communications[communication.name] = get_communication_entry(communication)
+            cache.set(communication.name, communications[communication.name])
+
+    return dict((message_id, communications[communication_name])
+                for message_id, communication_name in communication_names.items()
+                if communication_name in communications)
+
+
+def get_communication_fields():
+    """Get `COMMUNICATION_FIELDS` and BCC field in Frappe versions that have it."""
+    if frappe.get_meta("Communication").has_field("bcc"):
+        return COMMUNICATION_FIELDS + ["bcc"]
+    return COMMUNICATION_FIELDS
+
+
+def get_communication_entry(communication):
+    """
+    Get compact communication to cache: name, frozenset of normalized emails of To, CC
+    and BCC recipients and delivery status.
+
+    :param communication: Communication with fields `get_communication_fields`
+    """
+    addresses = getaddresses([communication.get(field) or ""
+                              for field in ("recipients", "cc", "bcc")])
+    return frappe._dict(name=communication.name,
+                        recipients=frozenset(normalize_email(email)
+                                             for name, email in addresses if email),
+                        delivery_status=communication.delivery_status)
+
+
+def normalize_email(email):
+    """
+    Get email address in lowercase with ASCII (IDNA) domain, so different spellings of
+    an address match.
+
+    :param email: email address
+    """
+    local_part, at, domain = frappe.as_unicode(email).strip().rpartition("@")
+    try:
+        domain = domain.encode("idna").decode("ascii")
+    except UnicodeError:
+        pass
+    return (local_part + at + domain).lower()
+
+
+def is_recipient(email, communication):
+    """
+    Check that email is a recipient of communication.
+
+    :param email: email address received from webhook request
+    :param communication: communication returned by `get_communications`
+    """
+    return bool(email) and normalize_email(email) in communication.recipients
+
+
+def get_communication_cache():
+    """
+    Get cache of communications of the current site in this worker process.
+
+    Size and TTL are taken from site config keys `sendgrid_communication_cache_size`
+    and `sendgrid_communication_cache_ttl`.
+    """
+    cache = _communication_caches.get(frappe.local.site)
+    if cache is None:
+        cache = _communication_caches.setdefault(frappe.local.site, LRUCache(
+            frappe.conf.get("sendgrid_communication_cache_size", COMMUNICATION_CACHE_SIZE),
+            frappe.conf.sendgrid_communication_cache_ttl or COMMUNICATION_CACHE_TTL))
+    return cache
+
+
+@frappe.whitelist()
+def get_communication_cache_stats():
+    """Get size, hits and misses of communication cache of the worker process."""
+    frappe.only_for("System Manager")
+    return get_communication_cache().get_stats()
+
+
+def get_communication_name(message_id):
+    """
+    Extract communication name from message id.
+
+    Returns None for message ids of other sites.
+
+    :param message_id: unuque message id received from webhook request
+    """
+    if message_id and "@{site}".format(site=frappe.local.site) in message_id:
+        return message_id.strip(" <>").split("@", 1)[0]
 
 
 def get_webhook_credentials():
     """
     Get SendGrid webhook credentials for all existing Email Accounts.
 
-    Credentials are stored in cache, generator method will be provided otherwise.
+    Returns list of credentials and Email Account name pairs, Email Account is None for
+    credentials from site config. Credentials are stored in cache, generator method will
+    be provided otherwise.
     """
     def _get_webhook_credentials():
         """
@@ -80,41 +464,158 @@ def get_webhook_credentials():
         Generator method that gets values from db.
         """
         email_accounts = frappe.get_all("Email Account",
-                                        fields=["sendgrid_webhook_credentials",
+                                        fields=["name",
+                                                "sendgrid_webhook_credentials",
                                                 "api_key"],
                                         filters={"enable_outgoing": 1,
                                                  "service": "SendGrid"})
         webhook_credentials = list()
         for account in email_accounts:
             if account.sendgrid_webhook_credentials and account.api_key:
-                webhook_credentials.append(account.sendgrid_webhook_credentials)
+                webhook_credentials.append((account.sendgrid_webhook_credentials,
+                                            account.name))
 
         if frappe.conf.sendgrid_webhook_credentials:
             webhook_credentials.append(
-                frappe.conf.sendgrid_webhook_credentials)
+                (frappe.conf.sendgrid_webhook_credentials, None))
 
         return webhook_credentials
 
-    return frappe.cache().get_value("sendgrid_webhook_credentials_list",
+    return frappe.cache().get_value("sendgrid_webhook_credentials",
                                     generator=_get_webhook_credentials)
 
 
+def get_webhook_account(token):
+    """
+    Find webhook credentials matching token of basic HTTP authorization.
+
+    Returns dict with `email_account` the credentials belong to, None when nothing
+    matches. Index of credentials is kept in process for `CREDENTIALS_INDEX_TTL` seconds
+    and reloaded earlier when token is not found.
+
+    :param token: base64 encoded 'username:password' received from webhook request
+    """
+    # header values are unicode, index keeps tokens as bytes
+    try:
+        token = token.encode("ascii")
+    except UnicodeError:
+        return
+
+    digest = hashlib.sha256(token).digest()
+    entry = _get_credentials_index().get(digest)
+
+    if not entry:
+        # credentials could be added since the index was loaded
+        entry = _get_credentials_index(refresh=True).get(digest)
+
+    if entry and hmac.compare_digest(entry[0], token):
+        return frappe._dict(email_account=entry[1])
+
+
+def _get_credentials_index(refresh=False):
+    """
+    Get index of SHA-256 digest of base64 encoded credentials for the current site.
+
+    :param refresh: reload index unless it was loaded a moment ago
+    """
+    now = time.time()
+    loaded_at, index = _credentials_indexes.get(frappe.local.site, (0, None))
+
+    if index is None or now - loaded_at > CREDENTIALS_INDEX_TTL or (
+            refresh and now - loaded_at > CREDENTIALS_INDEX_MIN_AGE):
+        index = dict()
+        for credentials, email_account in get_webhook_credentials():
+            token = base64.b64encode(credentials.encode("utf-8"))
+            index[hashlib.sha256(token).digest()] = (token, email_account)
+
+        _credentials_indexes[frappe.local.site] = (now, index)
+
+    return index
+
+
 def clear_cache():
-    """Remove SendGrid webhook credentials from cache."""
-    frappe.cache().delete_value("sendgrid_webhook_credentials_list")
+    """Remove webhook credentials, communications and X-SMTPAPI headers from cache."""
+    frappe.cache().delete_value("sendgrid_webhook_credentials")
+    _credentials_indexes.pop(frappe.local.site, None)
+    _communication_caches.pop(frappe.local.site, None)
+    smtpapi.clear_cache()
+
+
+def global_unsubscribe(emails, commit=False, chunk_size=UNSUBSCRIBE_CHUNK_SIZE,
+                       imported=False):
+    """
+    Set Global Unsubscribe flag for many emails with bulk inserts.
 
+    Emails are processed in chunks, every chunk takes one query to find emails that are
+    globally unsubscribed already and one insert of the rest.
 
-def global_unsubscribe_and_commit(email):
-    """Set Global Unsubscribe flag for the email and commit to db.
+    Returns number of emails that were unsubscribed.
 
-    :param email: email address to unsubscribe
+    :param emails: iterable of email addresses to unsubscribe
+    :param commit: commit after every chunk, otherwise it's up to the caller
+    :param chunk_size: maximum number of emails inserted at once
+    :param imported: emails come from SendGrid, records are marked so they are not
+                     pushed back by `push_unsubscribes`
     """
-    try:
-        unsubscribe_data = {"doctype": "Email Unsubscribe",
-                            "email": email,
-                            "global_unsubscribe": 1}
-        frappe.get_doc(unsubscribe_data).insert(ignore_permissions=True)
-    except frappe.DuplicateEntryError:
-        pass
-    else:
-        frappe.db.commit()
+    unsubscribed = 0
+    for chunk in chunked(emails, chunk_size):
+        unsubscribed += _global_unsubscribe(chunk, imported)
+        if commit:
+            frappe.db.commit()
+
+    return unsubscribed
+
+
+def _global_unsubscribe(emails, imported=False):
+    """
+    Set Global Unsubscribe flag for one chunk of emails without commit.
+
+    :param emails: list of email addresses to unsubscribe
+    :param imported: emails come from SendGrid
+    """
+    # emails are compared case insensitive by the database
+    emails = dict((email.lower(), email) for email in emails if email)
+    if not emails:
+        return 0
+
+    existing_emails = set(email.lower() for email in frappe.db.sql_list("""select email
+        from `tabEmail Unsubscribe`
+        where global_unsubscribe=1 and email in ({0})""".format(
+        ", ".join(["%s"] * len(emails))), list(emails.values())))
+
+    new_emails = [email for key, email in emails.items() if key not in existing_emails]
+    if not new_emails:
+        return 0
+
+    timestamp = now()
+    user = frappe.session.user
+    values = list()
+    for email in new_emails:
+        values.extend([frappe.generate_hash(length=10), timestamp, timestamp, user, user,
+                       email, 1 if imported else 0])
+
+    frappe.db.sql("""insert into `tabEmail Unsubscribe`
+        (name, creation, modified, owner, modified_by, docstatus, email, global_unsubscribe,
+            sendgrid_imported)
+        values {0}""".format(
+        ", ".join(["(%s, %s, %s, %s, %s, 0, %s, 1, %s)"] * len(new_emails))), values)
+
+    return len(new_emails)
+
+
+def chunked(iterable, size):
+    """
+    Split iterable into lists of given size, the last list may be shorter.
+
+    :param iterable: iterable to split
+    :param size: maximum size of a single list
+    """
+    chunk = list()
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = list()
+
+    if chunk:
+        yield chunk
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, Semilimes
+# For license information, please see license.txt
+
+import uuid
+import random
+
+
+# domain of synthetic email addresses, never delivered to
+EMAIL_DOMAIN = "sendgrid-benchmark.invalid"
+
+# events of a typical message in the order SendGrid sends them
+EVENT_SEQUENCE = ("processed", "delivered", "open", "click")
+
+# events that replace the end of the sequence for some messages
+FAILURE_EVENTS = ("deferred", "bounce", "dropped")
+
+
+def get_email(i):
+    """
+    Get synthetic email address.
+
+    :param i: number of the address
+    """
+    return "recipient-{}@{}".format(i, EMAIL_DOMAIN)
+
+
+def generate_events(communications, count, site, failure_rate=0.05, seed=None):
+    """
+    Generate SendGrid webhook events for communications.
+
+    Every communication gets events of `EVENT_SEQUENCE`, some of them end with an event
+    of `FAILURE_EVENTS` instead. Events of different messages are interleaved and some
+    are shuffled, like SendGrid delivers them.
+
+    :param communications: list of communication name and recipient email pairs
+    :param count: number of events to generate
+    :param site: site name used in message id
+    :param failure_rate: share of messages that fail
+    :param seed: seed of random generator, for reproducible payloads
+    """
+    rand = random.Random(seed)
+    timestamp = 1475000000
+    events = list()
+
+    while len(events) < count:
+        for name, email in communications:
+            sequence = list(EVENT_SEQUENCE)
+            if rand.random() < failure_rate:
+                sequence = sequence[:rand.randint(1, 2)] + [rand.choice(FAILURE_EVENTS)]
+
+            for event_type in sequence:
+                timestamp += rand.randint(0, 3)
+                event = {"event": event_type,
+                         "email": email,
+                         "timestamp": timestamp,
+                         "sg_event_id": uuid.uuid4().hex,
+                         "sg_message_id": uuid.uuid4().hex,
+                         "smtp-id": "<{}@{}>".format(uuid.uuid4().hex, site),
+                         "message_id": "<{}@{}>".format(name, site),
+                         "category": "benchmark"}
+                if event_type == "dropped":
+                    event["reason"] = "Bounced Address"
+                if event_type == "click":
+                    event["url"] = "https://example.com/"
+                events.append(event)
+
+            if len(events) >= count:
+                break
+
+    events = events[:count]
+
+    # a few events arrive out of order
+    for i in range(len(events) // 20):
+        a, b = rand.randrange(len(events)), rand.randrange(len(events))
+        events[a], events[b] = events[b], events[a]
+
+    return events
@@ -0,0 +1,483 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, Semilimes
+# For license information, please see license.txt
+
+from __future__ import print_function
+
+import io
+import gc
+import json
+import time
+import smtplib
+import resource
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+
+import frappe
+from frappe.utils import now, cint
+
+from .. import mail_send, smtpapi, suppression
+from ..account import global_unsubscribe
+from ..sendgrid import (unsubscribe_emails, push_unsubscribes, get_sync_key,
+                        get_pending_deletions_key)
+from ..event_stream import EventReader
+from ..webhook_events import process_events, set_meta_in_email_body
+from .events import EMAIL_DOMAIN, EVENT_SEQUENCE, get_email, generate_events
+from .stub import StubSendGrid, StubSMTP
+
+
+# prefix of names of synthetic communications
+COMMUNICATION_PREFIX = "sg-bench-"
+
+# first synthetic email pushed to SendGrid, emails before it are unsubscribed by other
+# scenarios
+PUSH_EMAIL_OFFSET = 10 ** 6
+
+# webhook payload sizes, in events
+PAYLOAD_SIZES = (1000, 10000)
+
+
+class QueryCounter(object):
+    """Count queries run via `frappe.db.sql` while active."""
+
+    def __init__(self):
+        self.count = 0
+        self._sql = None
+
+    def __enter__(self):
+        self._sql = frappe.db.sql
+
+        def sql(*args, **kwargs):
+            self.count += 1
+            return self._sql(*args, **kwargs)
+
+        frappe.db.sql = sql
+        return self
+
+    def __exit__(self, *args):
+        frappe.db.sql = self._sql
+
+
+def run(output=None, sizes=PAYLOAD_SIZES, repeats=5, suppressed=5000, emails=1000):
+    """
+    Run all benchmark scenarios against the current site and save results as JSON.
+
+    Synthetic communications and unsubscribes are removed afterwards. Run with
+    `bench --site {site} execute sendgrid_integration.benchmarks.run.run`.
+
+    :param output: path of results file, `sendgrid_benchmark.json` in site dir by default
+    :param sizes: webhook payload sizes, in events
+    :param repeats: payloads of every size applied
+    :param suppressed: emails in every suppression list of the stub
+    :param emails: recipients of the email sent by mail send scenarios
+    """
+    results = {"site": frappe.local.site,
+               "started": now(),
+               "scenarios": list()}
+
+    try:
+        for size in sizes:
+            results["scenarios"].append(bench_process_events(cint(size), cint(repeats)))
+            results["scenarios"].append(bench_event_reader(cint(size), cint(repeats)))
+
+        results["scenarios"].append(bench_unsubscribe_emails(cint(suppressed),
+                                                             batch_key="emails"))
+        results["scenarios"].append(bench_unsubscribe_emails(cint(suppressed),
+                                                             batch_key=None))
+        results["scenarios"].append(bench_push_unsubscribes(cint(suppressed)))
+        results["scenarios"].extend(bench_mail_send(cint(emails)))
+        results["scenarios"].extend(bench_smtpapi_header(cint(emails) * 10))
+    finally:
+        cleanup()
+
+    output = output or frappe.get_site_path("sendgrid_benchmark.json")
+    with open(output, "w") as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+
+    for scenario in results["scenarios"]:
+        print(json.dumps(scenario, sort_keys=True))
+    print("Results saved to {}".format(output))
+
+    return output
+
+
+def bench_process_events(size, repeats):
+    """
+    Apply webhook payloads of `size` events via `process_events`.
+
+    :param size: events per payload
+    :param repeats: payloads applied, each with new events
+    """
+    communications = create_communications(max(size // len(EVENT_SEQUENCE), 1))
+    payloads = [generate_events(communications, size, frappe.local.site, seed=i)
+                for i in range(repeats)]
+
+    timings = list()
+    rss = get_peak_rss()
+    with QueryCounter() as queries:
+        for payload in payloads:
+            started = time.time()
+            process_events(payload)
+            frappe.db.commit()
+            timings.append(time.time() - started)
+
+    return get_result("process_events", size, timings, queries=queries.count,
+                      peak_rss_growth=get_peak_rss() - rss)
+
+
+def bench_event_reader(size, repeats):
+    """
+    Decode webhook payload of `size` events with `EventReader`.
+
+    :param size: events per payload
+    :param repeats: times the payload is decoded
+    """
+    communications = [(COMMUNICATION_PREFIX + str(i), get_email(i))
+                      for i in range(max(size // len(EVENT_SEQUENCE), 1))]
+    body = json.dumps(generate_events(communications, size, frappe.local.site)).encode(
+        "utf-8")
+
+    timings = list()
+    rss = get_peak_rss()
+    for i in range(repeats):
+        started = time.time()
+        for event in EventReader(io.BytesIO(body)):
+            pass
+        timings.append(time.time() - started)
+
+    return get_result("event_reader", size, timings, payload_bytes=len(body),
+                      peak_rss_growth=get_peak_rss() - rss)
+
+
+def bench_unsubscribe_emails(count, batch_key="emails"):
+    """
+    Sync a suppression list of `count` emails from stub SendGrid API.
+
+    :param count: emails in the list
+    :param batch_key: see `unsubscribe_emails`, None removes emails one by one
+    """
+    stub = StubSendGrid().start()
+    api_key = "benchmark"
+    endpoint, remove_endpoint = "/suppression/bounces", None
+    if not batch_key:
+        endpoint, remove_endpoint = "/suppression/unsubscribes", "/asm/suppressions/global"
+
+    stub.add_suppressions(endpoint.rsplit("/", 1)[1],
+                          [get_email(i) for i in range(count)])
+
+    api_url = frappe.conf.sendgrid_api_url
+    frappe.conf.sendgrid_api_url = stub.url
+    rss = get_peak_rss()
+    try:
+        with QueryCounter() as queries:
+            started = time.time()
+            unsubscribe_emails(api_key, endpoint, batch_key=batch_key,
+                               remove_endpoint=remove_endpoint, full_sync=True)
+            timings = [time.time() - started]
+    finally:
+        frappe.conf.sendgrid_api_url = api_url
+        stub.stop()
+        for name in ("checkpoint", "watermark"):
+            frappe.db.set_global(get_sync_key(name, api_key, endpoint), None)
+        frappe.cache().delete(frappe.cache().make_key(
+            get_pending_deletions_key(api_key, remove_endpoint or endpoint)))
+        frappe.db.commit()
+
+    return get_result("unsubscribe_emails" if batch_key else "unsubscribe_emails_one_by_one",
+                      count, timings, queries=queries.count,
+                      http_requests=stub.requests, rate_limited=stub.rate_limited,
+                      peak_rss_growth=get_peak_rss() - rss)
+
+
+def bench_push_unsubscribes(count):
+    """
+    Push `count` new global unsubscribes to stub SendGrid API.
+
+    :param count: emails unsubscribed
+    """
+    stub = StubSendGrid().start()
+    api_key = "benchmark"
+    endpoint = "/asm/suppressions/global"
+    watermark_key = get_sync_key("push_watermark", api_key, endpoint)
+
+    # only records created by the benchmark are pushed
+    frappe.db.set_global(watermark_key, "{}|".format(now()))
+    global_unsubscribe([get_email(PUSH_EMAIL_OFFSET + i) for i in range(count)],
+                       commit=True)
+
+    api_url = frappe.conf.sendgrid_api_url
+    frappe.conf.sendgrid_api_url = stub.url
+    rss = get_peak_rss()
+    try:
+        with QueryCounter() as queries:
+            started = time.time()
+            push_unsubscribes(api_key, endpoint)
+            timings = [time.time() - started]
+    finally:
+        frappe.conf.sendgrid_api_url = api_url
+        stub.stop()
+        frappe.db.set_global(watermark_key, None)
+        frappe.db.commit()
+
+    return get_result("push_unsubscribes", count, timings, queries=queries.count,
+                      http_requests=stub.requests, rate_limited=stub.rate_limited,
+                      pushed=len(stub.global_suppressions),
+                      peak_rss_growth=get_peak_rss() - rss)
+
+
+def bench_mail_send(count):
+    """
+    Send an Email Queue with `count` recipients via `mail_send.send_email` one recipient
+    at a time the way Frappe flushes Email Queue, over SMTP to a local sink and with Web
+    API to stub SendGrid API, which sends all recipients in batches of
+    `MAX_PERSONALIZATIONS` on the first call.
+
+    :param count: recipients
+    """
+    sender = "Benchmark <sender@{}>".format(EMAIL_DOMAIN)
+    recipients = [get_email(i) for i in range(count)]
+    email = create_email_queue(sender, get_message(sender), recipients)
+    email_account = frappe._dict(name="SendGrid Benchmark", api_key="benchmark",
+                                 service="SendGrid")
+
+    stub_smtp = StubSMTP().start()
+    stub = StubSendGrid().start()
+    api_url = frappe.conf.sendgrid_api_url
+    frappe.conf.sendgrid_api_url = stub.url
+    local_accounts = getattr(frappe.local, "sendgrid_web_api_accounts", None)
+    results = list()
+    try:
+        # session of the sink in place of the one of sender Email Account
+        frappe.local.sendgrid_smtp_session = frappe._dict(
+            email=email.name, connected=True, pending=set(recipients),
+            smtp_server=frappe._dict(sess=smtplib.SMTP(*stub_smtp.address)))
+        frappe.local.sendgrid_web_api_accounts = dict()
+        started = time.time()
+        send_email_queue(email, sender)
+        results.append(get_result("mail_send_smtp", count, [time.time() - started],
+                                  delivered=stub_smtp.recipients))
+
+        reset_email_queue(email)
+        frappe.local.sendgrid_web_api_accounts = {
+            "sender@{}".format(EMAIL_DOMAIN): email_account}
+        with QueryCounter() as queries:
+            started = time.time()
+            send_email_queue(email, sender)
+            finished = time.time()
+        results.append(get_result("mail_send_web_api", count, [finished - started],
+                                  queries=queries.count, http_requests=stub.requests,
+                                  delivered=stub.personalizations))
+    finally:
+        frappe.conf.sendgrid_api_url = api_url
+        if local_accounts is None:
+            del frappe.local.sendgrid_web_api_accounts
+        else:
+            frappe.local.sendgrid_web_api_accounts = local_accounts
+        stub.stop()
+        stub_smtp.stop()
+
+    return results
+
+
+def send_email_queue(email, sender):
+    """
+    Send every recipient of Email Queue with `mail_send.send_email` and mark it sent,
+    like Frappe's `send_one` does.
+
+    :param email: Email Queue
+    :param sender: sender of the email
+    """
+    recipients_list = mail_send.get_recipients(email.name)
+    for recipient in recipients_list:
+        if recipient.status != "Not Sent":
+            continue
+
+        message = mail_send.prepare_message(email, recipient.recipient, recipients_list)
+        mail_send.send_email(email, sender, recipient.recipient, message)
+        frappe.db.sql("""update `tabEmail Queue Recipient` set status='Sent', modified=%s
+            where name=%s""", (now(), recipient.name), auto_commit=True)
+
+
+def create_email_queue(sender, message, recipients):
+    """
+    Insert synthetic Email Queue with recipients.
+
+    :param sender: sender of the email
+    :param message: MIME message
+    :param recipients: recipient emails
+    """
+    timestamp = now()
+    user = frappe.session.user
+    name = "{}{}".format(COMMUNICATION_PREFIX, frappe.generate_hash(length=10))
+    frappe.db.sql("""insert into `tabEmail Queue`
+        (name, creation, modified, owner, modified_by, docstatus, status, sender,
+        message) values (%s, %s, %s, %s, %s, 0, 'Not Sent', %s, %s)""",
+        (name, timestamp, timestamp, user, user, sender, message))
+
+    values = list()
+    for i, recipient in enumerate(recipients):
+        values.extend(["{}{}".format(name, i), timestamp, timestamp, user, user, name,
+                       i + 1, recipient])
+    frappe.db.sql("""insert into `tabEmail Queue Recipient`
+        (name, creation, modified, owner, modified_by, docstatus, parent, parenttype,
+        parentfield, idx, recipient, status)
+        values {}""".format(", ".join(["""(%s, %s, %s, %s, %s, 0, %s, 'Email Queue',
+            'recipients', %s, %s, 'Not Sent')"""] * len(recipients))),
+        values)
+    frappe.db.commit()
+
+    return frappe._dict(name=name, sender=sender, message=message,
+                        reference_doctype=None)
+
+
+def reset_email_queue(email):
+    """
+    Mark recipients of synthetic Email Queue not sent.
+
+    :param email: Email Queue
+    """
+    frappe.db.sql("""update `tabEmail Queue Recipient` set status='Not Sent'
+        where parent=%s""", email.name)
+    frappe.db.commit()
+
+
+def bench_smtpapi_header(count):
+    """
+    Set X-SMTPAPI header of `count` messages via `set_meta_in_email_body`, with header
+    template of the Email Account cached and with settings serialized per message.
+
+    :param count: messages
+    """
+    email_account = frappe._dict(name="SendGrid Benchmark", service="SendGrid",
+                                 modified=now(), sendgrid_categories="news\nbenchmark",
+                                 sendgrid_asm_group_id=1, sendgrid_ip_pool="pool",
+                                 sendgrid_tracking="Enabled")
+    emails = [frappe._dict(msg_root=MIMEMultipart(), email_account=email_account)
+              for i in range(count)]
+    for email in emails:
+        email.msg_root["Message-Id"] = "<{}@{}>".format(frappe.generate_hash(length=20),
+                                                        frappe.local.site)
+
+    smtpapi.clear_cache()
+    started = time.time()
+    for email in emails:
+        set_meta_in_email_body(email)
+    results = [get_result("smtpapi_header", count, [time.time() - started])]
+
+    # the way the header was built before templates were cached
+    started = time.time()
+    for email in emails:
+        settings = smtpapi.get_account_settings(email_account)
+        settings["unique_args"] = {"message_id": email.msg_root["Message-Id"]}
+        json.dumps(settings)
+    results.append(get_result("smtpapi_header_uncached", count, [time.time() - started]))
+    smtpapi.clear_cache()
+
+    return results
+
+
+def get_message(sender):
+    """
+    Get MIME message with plain text and html parts like the ones in Email Queue.
+
+    :param sender: sender of the message
+    """
+    message = MIMEMultipart("alternative")
+    message["From"] = sender
+    message["Subject"] = "SendGrid benchmark"
+    message["Message-Id"] = "<{}@{}>".format(frappe.generate_hash(length=20),
+                                             frappe.local.site)
+    text = "SendGrid benchmark message. " * 40
+    message.attach(MIMEText(text, "plain", "utf-8"))
+    message.attach(MIMEText("<p>{}</p>".format(text), "html", "utf-8"))
+    return message.as_string()
+
+
+def get_result(scenario, size, timings, queries=None, **kwargs):
+    """
+    Summarize timings of a scenario.
+
+    :param scenario: name of the scenario
+    :param size: events or emails processed by every run
+    :param timings: seconds every run took
+    :param queries: database queries run by all runs
+    """
+    timings = sorted(timings)
+    result = {"scenario": scenario,
+              "size": size,
+              "runs": len(timings),
+              "per_second": round(size * len(timings) / (sum(timings) or 1e-9), 1),
+              "p50": round(get_percentile(timings, 50), 4),
+              "p99": round(get_percentile(timings, 99), 4)}
+    if queries is not None:
+        result["queries_per_item"] = round(float(queries) / (size * len(timings)), 4)
+    result.update(kwargs)
+    return result
+
+
+def get_percentile(values, percentile):
+    """
+    Get percentile of sorted values, nearest rank.
+
+    :param values: sorted list of values
+    :param percentile: percentile, 0 to 100
+    """
+    if not values:
+        return 0
+    rank = int(round(percentile / 100.0 * len(values) + 0.5)) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def get_peak_rss():
+    """Get peak resident set size of the process in kilobytes."""
+    gc.collect()
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def create_communications(count):
+    """
+    Insert synthetic sent communications with one query.
+
+    Returns list of communication name and recipient email pairs.
+
+    :param count: number of communications
+    """
+    timestamp = now()
+    user = frappe.session.user
+    communications = list()
+    values = list()
+    for i in range(count):
+        name = "{}{}".format(COMMUNICATION_PREFIX, frappe.generate_hash(length=10))
+        email = get_email(i)
+        communications.append((name, email))
+        values.extend([name, timestamp, timestamp, user, user, email])
+
+    frappe.db.sql("""insert into `tabCommunication`
+        (name, creation, modified, owner, modified_by, docstatus, communication_type,
+        communication_medium, sent_or_received, subject, recipients, delivery_status)
+        values {}""".format(", ".join(["""(%s, %s, %s, %s, %s, 0, 'Communication',
+            'Email', 'Sent', 'SendGrid benchmark', %s, 'Sent')"""] * count)),
+        values)
+    frappe.db.commit()
+
+    return communications
+
+
+def cleanup():
+    """Delete synthetic communications, events, emails and unsubscribes."""
+    frappe.db.sql("""delete from `tabSendGrid Event`
+        where communication like %s""", COMMUNICATION_PREFIX + "%")
+    frappe.db.sql("""delete from `tabCommunication` where name like %s""",
+                  COMMUNICATION_PREFIX + "%")
+    frappe.db.sql("""delete from `tabEmail Queue Recipient` where parent like %s""",
+                  COMMUNICATION_PREFIX + "%")
+    frappe.db.sql("""delete from `tabEmail Queue` where name like %s""",
+                  COMMUNICATION_PREFIX + "%")
+
+    frappe.db.sql("""delete from `tabEmail Unsubscribe` where email like %s""",
+                  "%@" + EMAIL_DOMAIN)
+
+    cache = frappe.cache()
+    suppression.remove(list(cache.sscan_iter(cache.make_key(suppression.SUPPRESSED_KEY),
+                                             match="*@" + EMAIL_DOMAIN)))
+    frappe.db.commit()
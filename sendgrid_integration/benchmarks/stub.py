@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, Semilimes
+# For license information, please see license.txt
+
+import json
+import time
+import threading
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn, TCPServer, StreamRequestHandler
+    from urlparse import urlparse, parse_qs
+    from urllib import unquote_plus
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn, TCPServer, StreamRequestHandler
+    from urllib.parse import urlparse, parse_qs, unquote_plus
+
+
+class StubSendGrid(object):
+    """
+    Local stub of SendGrid API v3 endpoints used by the app.
+
+    Suppression lists support limit, offset and start_time, individual deletions from
+    '/asm/suppressions/global' are rate limited with X-RateLimit-* headers and 429
+    responses. Requests are counted per method and endpoint, bodies of mail/send requests
+    are kept in `mails`.
+
+    :param rate_limit: requests to '/asm/suppressions/global' allowed per window
+    :param rate_window: seconds of rate limit window
+    :param accepted_mails: mail/send requests accepted before the stub fails with 500,
+                           all are accepted when not set
+    """
+
+    def __init__(self, rate_limit=600, rate_window=60, accepted_mails=None):
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.window_started = time.time()
+        self.window_requests = 0
+
+        self.lists = dict()
+        self.global_suppressions = set()
+        self.webhook_settings = {"enabled": False, "url": ""}
+        self.requests = dict()
+        self.rate_limited = 0
+        self.personalizations = 0
+        self.mails = list()
+        self.accepted_mails = accepted_mails
+        self.lock = threading.Lock()
+        self.server = None
+
+    @property
+    def url(self):
+        """Base url of the stub to be used as `sendgrid_api_url`."""
+        return "http://127.0.0.1:{}/v3/".format(self.server.server_address[1])
+
+    def add_suppressions(self, name, emails, created=None):
+        """
+        Add emails to suppression list.
+
+        :param name: name of the list, e.g. 'bounces'
+        :param emails: emails to add
+        :param created: unix timestamp emails were added at
+        """
+        created = created or int(time.time())
+        self.lists.setdefault(name, []).extend({"email": email, "created": created}
+                                               for email in emails)
+
+    def start(self):
+        """Start serving on a free local port in a background thread."""
+        self.server = _ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.server.stub = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, method, endpoint):
+        with self.lock:
+            key = "{} {}".format(method, endpoint)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def take_rate_limit(self):
+        """Count request against rate limit, return remaining requests and reset time."""
+        with self.lock:
+            now = time.time()
+            if now - self.window_started >= self.rate_window:
+                self.window_started = now
+                self.window_requests = 0
+
+            self.window_requests += 1
+            remaining = self.rate_limit - self.window_requests
+            if remaining < 0:
+                self.rate_limited += 1
+            return remaining, int(self.window_started + self.rate_window)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go in one packet, otherwise delayed ACK adds 40ms per request
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, data=None, headers=None):
+        body = json.dumps(data).encode("utf-8") if data is not None else b""
+        self.send_response(status)
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        if data is not None:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length).decode("utf-8")) if length else None
+
+    def _route(self, method):
+        stub = self.server.stub
+        url = urlparse(self.path)
+        path = url.path[len("/v3"):] if url.path.startswith("/v3") else url.path
+        params = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+        data = self._read_json() if method in ("POST", "PATCH", "DELETE") else None
+
+        if path.startswith("/suppression/"):
+            stub.count(method, "/suppression")
+            name = path[len("/suppression/"):].strip("/")
+            items = stub.lists.get(name, [])
+
+            if method == "GET":
+                start_time = int(params.get("start_time") or 0)
+                offset = int(params.get("offset") or 0)
+                limit = int(params.get("limit") or 500)
+                items = [item for item in items if item["created"] >= start_time]
+                return self._send(200, items[offset:offset + limit])
+
+            if method == "DELETE":
+                emails = set((data or {}).get("emails") or [])
+                with stub.lock:
+                    stub.lists[name] = [item for item in stub.lists.get(name, [])
+                                        if item["email"] not in emails]
+                return self._send(204)
+
+        if path.startswith("/asm/suppressions/global"):
+            stub.count(method, "/asm/suppressions/global")
+            remaining, reset = stub.take_rate_limit()
+            headers = {"X-RateLimit-Limit": str(stub.rate_limit),
+                       "X-RateLimit-Remaining": str(max(remaining, 0)),
+                       "X-RateLimit-Reset": str(reset)}
+            if remaining < 0:
+                return self._send(429, {"errors": [{"message": "too many requests"}]},
+                                  headers)
+
+            if method == "DELETE":
+                email = unquote_plus(path.rsplit("/", 1)[1])
+                with stub.lock:
+                    stub.global_suppressions.discard(email)
+                    stub.lists["unsubscribes"] = [
+                        item for item in stub.lists.get("unsubscribes", [])
+                        if item["email"] != email]
+                return self._send(204, headers=headers)
+
+            if method == "POST":
+                emails = (data or {}).get("recipient_emails") or []
+                with stub.lock:
+                    # global suppressions are listed as unsubscribes
+                    new_emails = [email for email in emails
+                                  if email not in stub.global_suppressions]
+                    stub.global_suppressions.update(emails)
+                stub.add_suppressions("unsubscribes", new_emails)
+                return self._send(201, {"recipient_emails": emails}, headers)
+
+        if path == "/user/webhooks/event/settings":
+            stub.count(method, path)
+            if method == "PATCH":
+                stub.webhook_settings.update(data or {})
+            return self._send(200, stub.webhook_settings)
+
+        if path == "/mail/send" and method == "POST":
+            stub.count(method, path)
+            with stub.lock:
+                if (stub.accepted_mails is not None and
+                        len(stub.mails) >= stub.accepted_mails):
+                    return self._send(500, {"errors": [{"message": "server error"}]})
+                stub.personalizations += len((data or {}).get("personalizations") or [])
+                stub.mails.append(data)
+            return self._send(202)
+
+        return self._send(404, {"errors": [{"message": "not found"}]})
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_POST(self):
+        self._route("POST")
+
+    def do_PATCH(self):
+        self._route("PATCH")
+
+    def do_DELETE(self):
+        self._route("DELETE")
+
+
+class StubSMTP(object):
+    """
+    Local SMTP sink that accepts every message, messages and recipients are counted.
+    """
+
+    def __init__(self):
+        self.messages = 0
+        self.recipients = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    @property
+    def address(self):
+        """Host and port of the sink."""
+        return self.server.server_address
+
+    def start(self):
+        """Start serving on a free local port in a background thread."""
+        self.server = _ThreadingTCPServer(("127.0.0.1", 0), _SMTPHandler)
+        self.server.stub = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving."""
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _ThreadingTCPServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _SMTPHandler(StreamRequestHandler):
+    def _reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+        self.wfile.flush()
+
+    def handle(self):
+        stub = self.server.stub
+        self._reply("220 stub ESMTP")
+        recipients = 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            command = line[:4].upper()
+            if command == b"EHLO":
+                self._reply("250-stub")
+                self._reply("250 8BITMIME")
+            elif command == b"MAIL":
+                recipients = 0
+                self._reply("250 OK")
+            elif command == b"RCPT":
+                recipients += 1
+                self._reply("250 OK")
+            elif command == b"DATA":
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                with stub.lock:
+                    stub.messages += 1
+                    stub.recipients += recipients
+                self._reply("250 OK")
+            elif command == b"QUIT":
+                self._reply("221 Bye")
+                return
+            else:
+                # HELO, RSET, NOOP
+                self._reply("250 OK")
@@ -2,45 +2,176 @@
 # Copyright (c) 2016, Semilimes
 # For license information, please see license.txt
 
+import time
+import threading
+from multiprocessing.pool import ThreadPool
+
 import frappe
 
-from .sendgrid import unsubscribe_emails
+from . import metrics
+from .sendgrid import unsubscribe_emails, push_unsubscribes
+
+
+# SendGrid lists of blacklisted emails with arguments for `unsubscribe_emails`
+SUPPRESSION_LISTS = (
+    # blocked emails
+    {"endpoint": "/suppression/blocks"},
+    # bounced emails
+    {"endpoint": "/suppression/bounces"},
+    # emails that were marked as spam
+    {"endpoint": "/suppression/spam_reports"},
+    # invalid emails
+    {"endpoint": "/suppression/invalid_emails"},
+    # unsubscribed emails
+    {"endpoint": "/suppression/unsubscribes",
+     "remove_endpoint": "/asm/suppressions/global",
+     "batch_key": None},
+)
 
+# defaults for concurrent sync, can be overridden in site config
+SYNC_THREADS = 4
+SYNC_THREADS_PER_API_KEY = 2
 
-def unsubscribe_blacklisted():
+
+def unsubscribe_blacklisted(full_sync=False):
     """
     Get blacklisted emails, unsubscribe them globally and delete them from SendGrid.
 
-    Run via Daily Scheduler.
+    Only emails blacklisted since the last run are requested. Run via Hourly Scheduler.
+
+    Lists of all API keys are processed concurrently by `sendgrid_sync_threads` threads,
+    at most `sendgrid_sync_threads_per_api_key` of them use the same API key at a time.
+    Email Accounts sharing an API key share its lists, so every list is processed once.
+    Every thread works with its own database connection.
+
+    :param full_sync: request whole blacklists instead of emails added since last run
     """
+    accounts_by_api_key = dict()
     for email_account in frappe.get_all("Email Account",
                                         filters={"service": "SendGrid",
                                                  "enable_outgoing": 1},
-                                        fields=["api_key",
+                                        fields=["name",
+                                                "api_key",
                                                 "sendgrid_webhook_credentials"]):
 
         # don't do it when SendGrid integration is inactive
         if not email_account.sendgrid_webhook_credentials or not email_account.api_key:
             continue
 
-        # process blocked emails
-        unsubscribe_emails(email_account.api_key,
-                           endpoint="/suppression/blocks")
+        accounts_by_api_key.setdefault(email_account.api_key, []).append(
+            email_account.name)
+
+    tasks = list()
+    semaphores = dict()
+    threads_per_api_key = (frappe.conf.sendgrid_sync_threads_per_api_key or
+                           SYNC_THREADS_PER_API_KEY)
+    for api_key, accounts in accounts_by_api_key.items():
+        semaphores[api_key] = threading.BoundedSemaphore(threads_per_api_key)
+        for suppression_list in SUPPRESSION_LISTS:
+            kwargs = dict(suppression_list, full_sync=full_sync)
+            tasks.append((", ".join(sorted(accounts)), api_key, kwargs))
+
+    if not tasks:
+        return
+
+    threads = frappe.conf.sendgrid_sync_threads or SYNC_THREADS
+    if threads > 1:
+        site, sites_path = frappe.local.site, frappe.local.sites_path
+        pool = ThreadPool(min(threads, len(tasks)))
+        try:
+            timings = pool.map(
+                lambda task: _unsubscribe_in_thread(site, sites_path,
+                                                    semaphores[task[1]], *task),
+                tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        timings = [_unsubscribe(*task) for task in tasks]
 
-        # process bounced emails
-        unsubscribe_emails(email_account.api_key,
-                           endpoint="/suppression/bounces")
+    report_timings(timings)
+    metrics.flush()
 
-        # process emails that were marked as spam
-        unsubscribe_emails(email_account.api_key,
-                           endpoint="/suppression/spam_reports")
 
-        # process invalid emails
-        unsubscribe_emails(email_account.api_key,
-                           endpoint="/suppression/invalid_emails")
+def _unsubscribe_in_thread(site, sites_path, semaphore, account, api_key, kwargs):
+    """
+    Process one blacklist in a separate thread with its own database connection.
+
+    :param site: site to connect to
+    :param sites_path: path of bench sites directory
+    :param semaphore: semaphore that limits threads using the same API key
+    :param account: names of Email Accounts sharing the API key
+    :param api_key: SendGrid API key of Email Accounts
+    :param kwargs: arguments for `unsubscribe_emails`
+    """
+    frappe.init(site=site, sites_path=sites_path)
+    try:
+        frappe.connect()
+        with semaphore:
+            return _unsubscribe(account, api_key, kwargs)
+    finally:
+        frappe.destroy()
+
+
+def _unsubscribe(account, api_key, kwargs):
+    """
+    Process one blacklist and return account names with start and end time.
+
+    :param account: names of Email Accounts sharing the API key
+    :param api_key: SendGrid API key of Email Accounts
+    :param kwargs: arguments for `unsubscribe_emails`
+    """
+    started = time.time()
+    with metrics.stage("sync"):
+        unsubscribe_emails(api_key, **kwargs)
+    return account, started, time.time()
+
 
-        # process unsubscribed emails
-        unsubscribe_emails(email_account.api_key,
-                           endpoint="/suppression/unsubscribes",
-                           remove_endpoint="/asm/suppressions/global",
-                           batch_key=None)
+def report_timings(timings):
+    """
+    Print wall-clock time spent on every API key, named by its Email Accounts.
+
+    :param timings: list of account names with start and end times of processed lists
+    """
+    accounts = dict()
+    for account, started, finished in timings:
+        if account in accounts:
+            started = min(started, accounts[account][0])
+            finished = max(finished, accounts[account][1])
+        accounts[account] = (started, finished)
+
+    for account, (started, finished) in sorted(accounts.items()):
+        frappe.errprint("SendGrid blacklists of {} processed in {:.2f}s".format(
+            account, finished - started))
+
+
+def push_unsubscribed():
+    """
+    Add emails globally unsubscribed in Frappe to SendGrid global suppressions of every
+    API key.
+
+    Enabled by `sendgrid_push_unsubscribes` in site config. Run via Hourly Scheduler.
+    """
+    if not frappe.conf.sendgrid_push_unsubscribes:
+        return
+
+    api_keys = set(email_account.api_key for email_account in frappe.get_all(
+        "Email Account",
+        filters={"service": "SendGrid", "enable_outgoing": 1},
+        fields=["api_key", "sendgrid_webhook_credentials"])
+        if email_account.api_key and email_account.sendgrid_webhook_credentials)
+
+    for api_key in api_keys:
+        with metrics.stage("push"):
+            push_unsubscribes(api_key)
+
+    metrics.flush()
+
+
+def reconcile_blacklisted():
+    """
+    Process whole blacklists to catch up emails missed by incremental runs.
+
+    Run via Weekly Scheduler.
+    """
+    unsubscribe_blacklisted(full_sync=True)
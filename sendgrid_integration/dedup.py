@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, Semilimes
+# For license information, please see license.txt
+
+import frappe
+
+
+# SendGrid retries webhook requests for up to 24 hours
+SEEN_EVENT_TTL = 24 * 60 * 60
+
+SEEN_EVENT_KEY = "sendgrid_seen_event|{}"
+STATS_KEY = "sendgrid_dedup_stats"
+
+
+def drop_duplicates(events):
+    """
+    Drop events with `sg_event_id` that was applied during the last `SEEN_EVENT_TTL`
+    seconds, and repeated events of the list.
+
+    Checking all ids of the batch takes one round trip. Ids are only remembered by
+    `remember` once their events are committed, so events of a request that fails,
+    even by a hard exit of the worker, are applied when SendGrid retries it. Events
+    without id are kept.
+
+    :param events: list of SendGrid events received from webhook request
+    """
+    cache = frappe.cache()
+    pipeline = cache.pipeline()
+
+    keys = [cache.make_key(SEEN_EVENT_KEY.format(event.get("sg_event_id")))
+            if event.get("sg_event_id") else None for event in events]
+    if not any(keys):
+        return events
+
+    for key in keys:
+        if key:
+            pipeline.exists(key)
+
+    seen = iter(pipeline.execute())
+    seen_keys = set()
+    unique_events = list()
+    for event, key in zip(events, keys):
+        if not key:
+            unique_events.append(event)
+        elif not next(seen) and key not in seen_keys:
+            unique_events.append(event)
+            seen_keys.add(key)
+
+    stats_key = cache.make_key(STATS_KEY)
+    pipeline.hincrby(stats_key, "events", len(events))
+    pipeline.hincrby(stats_key, "duplicates", len(events) - len(unique_events))
+    pipeline.execute()
+
+    return unique_events
+
+
+def remember(events):
+    """
+    Remember ids of committed events, so retries of them are dropped by
+    `drop_duplicates`.
+
+    :param events: list of SendGrid events that were applied and committed
+    """
+    cache = frappe.cache()
+    ttl = frappe.conf.sendgrid_seen_event_ttl or SEEN_EVENT_TTL
+    keys = [cache.make_key(SEEN_EVENT_KEY.format(event.get("sg_event_id")))
+            for event in events if event.get("sg_event_id")]
+    if not keys:
+        return
+
+    pipeline = cache.pipeline()
+    for key in keys:
+        pipeline.set(key, 1, ex=ttl)
+    pipeline.execute()
+
+
+@frappe.whitelist()
+def get_stats():
+    """
+    Get number of webhook events checked for duplicates, duplicates dropped and hit rate.
+    """
+    frappe.only_for("System Manager")
+
+    cache = frappe.cache()
+    # RedisWrapper.hgetall prefixes the key and unpickles values, pipeline is not wrapped
+    stats = cache.pipeline().hgetall(cache.make_key(STATS_KEY)).execute()[0] or {}
+    events = int(stats.get("events") or 0)
+    duplicates = int(stats.get("duplicates") or 0)
+
+    return {"events": events,
+            "duplicates": duplicates,
+            "hit_rate": float(duplicates) / events if events else 0}
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, Semilimes
+# For license information, please see license.txt
+
+import time
+import urllib
+import hashlib
+
+import redis
+import frappe
+
+
+QUEUE_KEY = "sendgrid_event_queue"
+PROCESSING_KEY = "sendgrid_event_queue_processing"
+LOCK_KEY = "sendgrid_event_queue_lock"
+LAG_KEY = "sendgrid_event_queue_lag"
+ATTEMPTS_KEY = "sendgrid_event_queue_attempts"
+DEAD_LETTER_KEY = "sendgrid_event_queue_dead"
+
+# failed attempts after which item is moved to the dead letter list
+MAX_ATTEMPTS = 5
+
+# seconds after which lock of crashed worker expires, renewed while draining
+LOCK_TIMEOUT = 600
+
+
+def push(data, email_account=None):
+    """
+    Add raw webhook request body to the queue.
+
+    Every item is prefixed with the time it was received at, so the queue lag can be
+    measured, and with Email Account the request was authenticated for. Returns queue
+    length after the push.
+
+    :param data: raw body of webhook request
+    :param email_account: Email Account the webhook request was authenticated for
+    """
+    cache = frappe.cache()
+    # new items go to the head, `pop` takes the oldest from the tail; RedisWrapper.lpush
+    # doesn't return the length
+    return redis.Redis.lpush(cache, cache.make_key(QUEUE_KEY), "{0:.6f}|{1}|{2}".format(
+        time.time(), urllib.quote_plus(email_account or ""), data))
+
+
+def pop():
+    """
+    Move the oldest item from the queue to the processing list and return it.
+
+    Item stays in the processing list until it is acknowledged, so it is not lost if
+    the worker dies before committing.
+    """
+    cache = frappe.cache()
+    return cache.rpoplpush(cache.make_key(QUEUE_KEY), cache.make_key(PROCESSING_KEY))
+
+
+def ack(item):
+    """
+    Remove processed item from the processing list.
+
+    :param item: item returned by `pop`
+    """
+    cache = frappe.cache()
+    # argument order of Redis.lrem differs between redis-py versions
+    redis.StrictRedis.lrem(cache, cache.make_key(PROCESSING_KEY), 1, item)
+    cache.hdel(cache.make_key(ATTEMPTS_KEY), get_item_id(item))
+
+
+def parse(item):
+    """
+    Split queue item into time it was received at, Email Account and raw request body.
+
+    :param item: item returned by `pop`
+    """
+    received_at, email_account, data = item.split("|", 2)
+    return float(received_at), urllib.unquote_plus(email_account) or None, data
+
+
+def requeue_unacknowledged():
+    """
+    Move items left in the processing list by a failed or crashed worker back to the
+    queue.
+
+    Items are moved atomically to the head of the queue, so they are applied after the
+    items waiting already; event order doesn't matter, statuses are coalesced by event
+    time. Every move counts a failed attempt of the item, items that failed
+    `MAX_ATTEMPTS` times are moved to the dead letter list instead.
+    """
+    cache = frappe.cache()
+    queue_key = cache.make_key(QUEUE_KEY)
+    while True:
+        item = cache.rpoplpush(cache.make_key(PROCESSING_KEY), queue_key)
+        if not item:
+            return
+
+        if cache.hincrby(cache.make_key(ATTEMPTS_KEY), get_item_id(item)) >= MAX_ATTEMPTS:
+            redis.StrictRedis.lrem(cache, queue_key, 1, item)
+            redis.Redis.lpush(cache, cache.make_key(DEAD_LETTER_KEY), item)
+            cache.hdel(cache.make_key(ATTEMPTS_KEY), get_item_id(item))
+            frappe.errprint("SendGrid event queue item moved to dead letters after {} "
+                            "failed attempts".format(MAX_ATTEMPTS))
+
+
+def get_item_id(item):
+    """
+    Get short id of queue item to count its attempts.
+
+    :param item: item returned by `pop`
+    """
+    return hashlib.sha1(item).hexdigest()
+
+
+def acquire_lock():
+    """
+    Acquire lock so only one worker drains the queue of a site at a time.
+
+    Returns token of the lock, None if another worker holds it.
+    """
+    cache = frappe.cache()
+    token = frappe.generate_hash(length=20)
+    if cache.set(cache.make_key(LOCK_KEY), token, nx=True, ex=LOCK_TIMEOUT):
+        return token
+
+
+def has_lock(token):
+    """
+    Check the lock is still held with the token.
+
+    :param token: token returned by `acquire_lock`
+    """
+    cache = frappe.cache()
+    return frappe.as_unicode(cache.get(cache.make_key(LOCK_KEY)) or "") == token
+
+
+def renew_lock(token):
+    """
+    Extend the lock for another `LOCK_TIMEOUT` seconds.
+
+    Returns False if the lock expired and another worker may hold it already.
+
+    :param token: token returned by `acquire_lock`
+    """
+    cache = frappe.cache()
+    return has_lock(token) and bool(cache.expire(cache.make_key(LOCK_KEY), LOCK_TIMEOUT))
+
+
+def release_lock(token):
+    """
+    Release lock acquired by `acquire_lock`, unless it expired and another worker holds
+    it now.
+
+    :param token: token returned by `acquire_lock`
+    """
+    cache = frappe.cache()
+    if has_lock(token):
+        cache.delete(cache.make_key(LOCK_KEY))
+
+
+def set_lag(received_at):
+    """
+    Remember how long the last processed item waited in the queue.
+
+    :param received_at: time the item was received at
+    """
+    frappe.cache().set_value(LAG_KEY, time.time() - received_at)
+
+
+@frappe.whitelist()
+def get_stats():
+    """
+    Get queue depth and lag.
+
+    `depth` - number of requests waiting in the queue, `processing` - number of requests
+    being processed, `oldest_age` - seconds the oldest waiting request waits already,
+    `last_lag` - seconds the last processed request waited in the queue,
+    `dead_letters` - number of requests that failed `MAX_ATTEMPTS` times and are kept
+    in the dead letter list.
+    """
+    frappe.only_for("System Manager")
+
+    cache = frappe.cache()
+    oldest = cache.lrange(QUEUE_KEY, -1, -1)
+    oldest_age = time.time() - parse(oldest[0])[0] if oldest else 0
+
+    return {"depth": cache.llen(QUEUE_KEY),
+            "processing": cache.llen(PROCESSING_KEY),
+            "oldest_age": oldest_age,
+            "last_lag": cache.get_value(LAG_KEY) or 0,
+            "dead_letters": cache.llen(DEAD_LETTER_KEY)}
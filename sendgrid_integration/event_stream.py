@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, Semilimes
+# For license information, please see license.txt
+
+import io
+import re
+import json
+
+
+# fields of SendGrid event used to process it
+EVENT_FIELDS = ("event", "email", "message_id", "timestamp", "sg_event_id",
+                "category", "reason")
+
+# bytes read from request stream at once
+READ_SIZE = 64 * 1024
+
+# events larger than that are considered malformed
+MAX_EVENT_SIZE = 1024 * 1024
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class EventReader(object):
+    """
+    Decode SendGrid events from JSON array in a stream one by one.
+
+    Only `READ_SIZE` bytes and the event being decoded are kept in memory. Events that
+    are malformed or miss required fields are skipped and counted in `skipped`, the rest
+    are yielded as compact dicts, see `compact_event`.
+
+    :param stream: file-like object with webhook request body
+    :param read_size: bytes read from the stream at once
+    :param fallback: function returning the whole body, used when the stream is empty
+                     because the body was read already
+    """
+
+    def __init__(self, stream, read_size=READ_SIZE, fallback=None):
+        self.stream = stream
+        self.read_size = read_size
+        self.fallback = fallback
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.skipped = 0
+        # inside of a malformed event, values found here are not counted as events
+        self.resyncing = False
+
+    def __iter__(self):
+        if self._peek() != "[":
+            raise ValueError("SendGrid webhook request is not a JSON array")
+        self.pos += 1
+
+        while True:
+            char = self._peek()
+            if not char or char == "]":
+                return
+
+            if char == ",":
+                self.pos += 1
+                continue
+
+            event = self._decode()
+            if event is None:
+                continue
+
+            event = compact_event(event)
+            if event:
+                self.resyncing = False
+                yield event
+            elif not self.resyncing:
+                self.skipped += 1
+
+    def _read(self):
+        """Read the next part of the stream, dropping the part that is processed."""
+        data = self.stream.read(self.read_size)
+        if not data and self.fallback and not self.buffer:
+            self.stream = io.BytesIO(self.fallback())
+            self.fallback = None
+            data = self.stream.read(self.read_size)
+
+        if not data:
+            self.eof = True
+            return False
+
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        """Skip whitespace and return the next character, empty string at the end."""
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._read():
+                return ""
+
+    def _decode(self):
+        """Decode value at the current position, skip it when it's malformed."""
+        while True:
+            try:
+                value, self.pos = self.decoder.raw_decode(self.buffer, self.pos)
+                return value
+            except ValueError:
+                # value could be cut at the end of the buffer
+                if (len(self.buffer) - self.pos < MAX_EVENT_SIZE and not self.eof and
+                        self._read()):
+                    continue
+
+            # continue from the next object, malformed event is counted once however
+            # many nested objects it has
+            if not self.resyncing:
+                self.skipped += 1
+            next_object = self.buffer.find("{", self.pos + 1)
+            if next_object == -1:
+                self.pos = len(self.buffer)
+                self.resyncing = True
+            else:
+                self.pos = next_object
+                self.resyncing = not self._starts_event(next_object)
+            return None
+
+    def _starts_event(self, pos):
+        """Check object at position follows '[' or ',' so it's an item of the array."""
+        pos -= 1
+        while pos >= 0 and self.buffer[pos] in " \t\n\r":
+            pos -= 1
+        return pos >= 0 and self.buffer[pos] in "[,"
+
+
+def compact_event(event):
+    """
+    Keep only `EVENT_FIELDS` of SendGrid event.
+
+    Returns None when event is not valid.
+
+    :param event: SendGrid event received from webhook request
+    """
+    if not isinstance(event, dict) or not event.get("event"):
+        return None
+
+    return dict((field, event.get(field)) for field in EVENT_FIELDS)
@@ -80,6 +80,12 @@ after_install = "sendgrid_integration.install.after_install"
 doc_events = {
     "Email Account": {
         "on_update": "sendgrid_integration.webhooks.sync"
+    },
+    "Email Queue": {
+        "before_insert": "sendgrid_integration.suppression.skip_suppressed_recipients"
+    },
+    "Email Unsubscribe": {
+        "on_trash": "sendgrid_integration.suppression.remove_unsubscribed"
     }
 }
 
@@ -88,23 +94,27 @@ doctype_js = {
 }
 
 make_email_body_message = "sendgrid_integration.webhook_events.set_meta_in_email_body"
+override_email_send = "sendgrid_integration.mail_send.send_email"
 
 # Scheduled Tasks
 # ---------------
 
 scheduler_events = {
-    # "all": [
-    #   "sendgrid_integration.tasks.all"
-    # ],
+    "all": [
+        "sendgrid_integration.webhook_events.drain_event_queue",
+        "sendgrid_integration.sendgrid_integration.doctype.sendgrid_engagement.sendgrid_engagement.flush_counters"
+    ],
+    "hourly": [
+        "sendgrid_integration.blacklist.unsubscribe_blacklisted",
+        "sendgrid_integration.blacklist.push_unsubscribed"
+    ],
     "daily": [
-        "sendgrid_integration.blacklist.unsubscribe_blacklisted"
+        "sendgrid_integration.sendgrid_integration.doctype.sendgrid_event.sendgrid_event.prune_events"
+    ],
+    "weekly": [
+        "sendgrid_integration.blacklist.reconcile_blacklisted",
+        "sendgrid_integration.suppression.rebuild"
     ],
-    # "hourly": [
-    #   "sendgrid_integration.tasks.hourly"
-    # ],
-    # "weekly": [
-    #   "sendgrid_integration.tasks.weekly"
-    # ]
     # "monthly": [
     #   "sendgrid_integration.tasks.monthly"
     # ]
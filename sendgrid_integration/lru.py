@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, Semilimes
+# For license information, please see license.txt
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    In-process cache that keeps at most `maxsize` least recently used entries, every
+    entry for at most `ttl` seconds.
+
+    :param maxsize: maximum number of entries, 0 disables the cache
+    :param ttl: seconds an entry is kept
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Get value of key, None when it is missing or expired.
+
+        :param key: key of the entry
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+
+            # most recently used entries are at the end
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def get_many(self, keys):
+        """
+        Get dict of key and value of keys that are cached.
+
+        :param keys: iterable of keys
+        """
+        values = dict()
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def set(self, key, value):
+        """
+        Cache value of key, the least recently used entries are evicted over `maxsize`.
+
+        :param key: key of the entry
+        :param value: value to cache, not None
+        """
+        if not self.maxsize:
+            return
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, keys):
+        """
+        Remove entries of keys.
+
+        :param keys: iterable of keys
+        """
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        """Remove all entries."""
+        with self.lock:
+            self.entries.clear()
+
+    def get_stats(self):
+        """Get number of entries, hits, misses and hit rate."""
+        lookups = self.hits + self.misses
+        return {"size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": float(self.hits) / lookups if lookups else 0}
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, Semilimes
+# For license information, please see license.txt
+
+import json
+import base64
+import quopri
+import socket
+import smtplib
+from email import message_from_string
+from email.header import decode_header
+from email.utils import parseaddr, getaddresses
+
+import frappe
+from frappe.utils import encode, now_datetime
+from frappe.email.smtp import SMTPServer
+from frappe.email.queue import prepare_message
+
+from .sendgrid import get_client, handle_http_error, handle_request_errors
+from .smtpapi import get_account_settings
+
+
+# SendGrid accepts at most 1000 personalizations in one request
+MAX_PERSONALIZATIONS = 1000
+
+# headers of the message passed to SendGrid, other headers are set by SendGrid or
+# replaced by request settings
+MESSAGE_HEADERS = ("In-Reply-To", "References", "List-Unsubscribe",
+                   "List-Unsubscribe-Post")
+
+# placeholders Frappe replaces for every recipient in `prepare_message`
+RECIPIENT_PLACEHOLDERS = ("<!--unsubscribe url-->", "<!--cc message-->",
+                          "<!--recipient-->")
+
+
+def send(email_account, message, recipients, after_send=None):
+    """
+    Send email to recipients with SendGrid Web API v3 mail/send.
+
+    Recipients are grouped up to `MAX_PERSONALIZATIONS` per request, every recipient
+    gets its own personalization with message id as custom argument, same as X-SMTPAPI
+    unique argument set by `set_meta_in_email_body`. Sending stops at the first failed
+    request, so recipients are sent in order.
+
+    Returns list of recipients the email was not sent to.
+
+    :param email_account: SendGrid Email Account document to send email with
+    :param message: dict with `from`, `reply_to`, `subject`, `content`, `headers` and
+                    `attachments` in SendGrid mail/send format
+    :param recipients: list of dicts with `to` and optional `cc` email lists,
+                       `message_id`, `substitutions` and `headers`
+    :param after_send: function called with every chunk of recipients sent
+    """
+    request_data = dict(message)
+    request_data.update(get_request_settings(email_account))
+
+    client = get_client(email_account.api_key)
+    for i in range(0, len(recipients), MAX_PERSONALIZATIONS):
+        chunk = recipients[i:i + MAX_PERSONALIZATIONS]
+        request_data["personalizations"] = [get_personalization(recipient)
+                                            for recipient in chunk]
+
+        if not _post(client, json.dumps(request_data)):
+            return recipients[i:]
+
+        if after_send:
+            after_send(chunk)
+
+    return []
+
+
+@handle_request_errors
+def _post(client, data):
+    r = client.post("/mail/send", data=data,
+                    headers={"Content-Type": "application/json"})
+    return not handle_http_error(r)
+
+
+def get_personalization(recipient):
+    """
+    Get mail/send personalization for recipient.
+
+    :param recipient: dict with `to`, `cc`, `message_id`, `substitutions` and `headers`
+    """
+    personalization = {"to": [{"email": email} for email in recipient["to"]]}
+    if recipient.get("cc"):
+        personalization["cc"] = [{"email": email} for email in recipient["cc"]]
+    if recipient.get("message_id"):
+        personalization["custom_args"] = {"message_id": recipient["message_id"]}
+    if recipient.get("substitutions"):
+        personalization["substitutions"] = recipient["substitutions"]
+    if recipient.get("headers"):
+        personalization["headers"] = recipient["headers"]
+    return personalization
+
+
+def get_request_settings(email_account):
+    """
+    Convert X-SMTPAPI settings of Email Account to mail/send format.
+
+    :param email_account: SendGrid Email Account document
+    """
+    settings = get_account_settings(email_account)
+    request_settings = dict()
+
+    if settings.get("category"):
+        request_settings["categories"] = settings["category"]
+
+    if settings.get("asm_group_id"):
+        request_settings["asm"] = {"group_id": settings["asm_group_id"]}
+
+    if settings.get("ip_pool"):
+        request_settings["ip_pool_name"] = settings["ip_pool"]
+
+    if settings.get("filters"):
+        enable = bool(settings["filters"]["opentrack"]["settings"]["enable"])
+        request_settings["tracking_settings"] = {"open_tracking": {"enable": enable},
+                                                 "click_tracking": {"enable": enable}}
+
+    return request_settings
+
+
+def parse_message(raw_message):
+    """
+    Convert MIME message to mail/send format.
+
+    Returns message dict for `send`, Message-Id and lowercase Cc addresses of the
+    message. Parts with Content-ID are sent as inline attachments.
+
+    :param raw_message: MIME message as string
+    """
+    mime = message_from_string(raw_message)
+
+    sender_name, sender_email = parseaddr(decode_header_value(mime["From"]))
+    message = {"from": {"email": sender_email},
+               "subject": decode_header_value(mime["Subject"]) or " "}
+    if sender_name:
+        message["from"]["name"] = sender_name
+
+    if mime["Reply-To"]:
+        message["reply_to"] = {"email": parseaddr(mime["Reply-To"])[1]}
+
+    headers = dict((header, decode_header_value(mime[header]))
+                   for header in MESSAGE_HEADERS if mime[header])
+    if headers:
+        message["headers"] = headers
+
+    text, html, attachments = None, None, list()
+    for part in mime.walk():
+        if part.is_multipart():
+            continue
+
+        payload = part.get_payload(decode=True) or ""
+        content_id = (part["Content-ID"] or "").strip().strip("<>")
+        if part.get_filename() or content_id:
+            attachment = {"content": base64.b64encode(payload),
+                          "filename": decode_header_value(part.get_filename()) or
+                          content_id,
+                          "type": part.get_content_type()}
+            if content_id:
+                attachment["content_id"] = content_id
+                attachment["disposition"] = "inline"
+            attachments.append(attachment)
+            continue
+
+        charset = part.get_content_charset() or "utf-8"
+        if part.get_content_type() == "text/plain" and text is None:
+            text = payload.decode(charset, "replace")
+        elif part.get_content_type() == "text/html" and html is None:
+            html = payload.decode(charset, "replace")
+
+    # plain text has to go first
+    message["content"] = [{"type": content_type, "value": value}
+                          for content_type, value in (("text/plain", text),
+                                                      ("text/html", html))
+                          if value]
+    if attachments:
+        message["attachments"] = attachments
+
+    cc = [email.lower() for name, email in getaddresses(mime.get_all("Cc") or [])
+          if email]
+
+    return message, mime["Message-Id"], cc
+
+
+def decode_header_value(value):
+    """
+    Decode MIME encoded header value.
+
+    :param value: header value
+    """
+    if not value:
+        return value
+
+    return u"".join(part.decode(charset or "utf-8", "replace")
+                    if isinstance(part, bytes) else part
+                    for part, charset in decode_header(value))
+
+
+def send_email(email, sender, recipient, message):
+    """
+    Send one recipient of Email Queue, hooked into Frappe email sending as
+    `override_email_send`.
+
+    When sender Email Account has 'Send via SendGrid Web API' checked, the first call for
+    Email Queue sends all its recipients that are not sent yet with one request per
+    `MAX_PERSONALIZATIONS` recipients and marks them sent, later calls only check the
+    recipient was sent. Recipient the email failed to be sent to raises
+    SMTPServerDisconnected and Frappe retries it later. Emails of other senders are sent
+    over SMTP like Frappe does.
+
+    :param email: Email Queue being sent
+    :param sender: sender of the email
+    :param recipient: recipient email address
+    :param message: MIME message prepared for the recipient
+    """
+    email_account = get_web_api_account(sender)
+    if not email_account:
+        send_smtp(email, sender, recipient, message)
+        return
+
+    if not hasattr(frappe.local, "sendgrid_sent_recipients"):
+        frappe.local.sendgrid_sent_recipients = dict()
+
+    sent_recipients = frappe.local.sendgrid_sent_recipients
+    if email.name not in sent_recipients:
+        sent_recipients[email.name] = send_queued_email(email_account, email)
+
+    sent = sent_recipients[email.name]
+    if recipient not in sent:
+        # next flush sends the rest again
+        del sent_recipients[email.name]
+        raise smtplib.SMTPServerDisconnected(
+            "SendGrid Web API request of {} failed".format(email_account.name))
+
+    sent.discard(recipient)
+    if not sent:
+        del sent_recipients[email.name]
+
+
+def send_queued_email(email_account, email):
+    """
+    Send Email Queue to all recipients that are not sent yet with SendGrid Web API,
+    recipients are marked sent after every request.
+
+    Returns set of recipients the email was sent to.
+
+    :param email_account: SendGrid Email Account document to send email with
+    :param email: Email Queue to send
+    """
+    recipients_list = get_recipients(email.name)
+    pending = [r.recipient for r in recipients_list if r.status == "Not Sent"]
+    if not pending:
+        return set()
+
+    message, message_id, cc = parse_message(encode(email.message))
+    recipients = [{"to": [recipient]} for recipient in pending]
+    if cc:
+        # recipients shown in Cc header get one copy together
+        to = [recipient for recipient in pending if recipient.lower() not in cc]
+        cc = [recipient for recipient in pending if recipient.lower() in cc]
+        recipients = [{"to": to or cc[:1], "cc": cc if to else cc[1:]}]
+
+    for mail_recipient in recipients:
+        mail_recipient["message_id"] = message_id
+        substitutions = get_substitutions(email, mail_recipient["to"][0],
+                                          recipients_list)
+        if substitutions:
+            mail_recipient["substitutions"] = substitutions
+            mail_recipient["headers"] = get_personal_headers(message, substitutions)
+
+    sent = set(pending)
+    for mail_recipient in send(email_account, message, recipients,
+                               after_send=lambda chunk: set_sent(email.name, chunk)):
+        sent.difference_update(mail_recipient["to"] + mail_recipient.get("cc", []))
+    return sent
+
+
+def get_substitutions(email, recipient, recipients_list):
+    """
+    Get values Frappe puts in place of recipient placeholders of the message, so one
+    request sends every recipient its own copy.
+
+    :param email: Email Queue
+    :param recipient: recipient email address
+    :param recipients_list: all recipients of Email Queue
+    """
+    placeholders = [placeholder for placeholder in RECIPIENT_PLACEHOLDERS
+                    if placeholder in email.message]
+    if not placeholders:
+        return None
+
+    # Frappe replaces placeholders of message with separated placeholders only
+    separator = "<!--sendgrid-->"
+    values = prepare_message(frappe._dict(email, message=separator.join(placeholders)),
+                             recipient, recipients_list).split(separator)
+
+    return dict((placeholder, frappe.as_unicode(quopri.decodestring(encode(value))))
+                for placeholder, value in zip(placeholders, values)
+                if value != placeholder)
+
+
+def get_personal_headers(message, substitutions):
+    """
+    Get message headers with placeholders replaced for one recipient, SendGrid only
+    substitutes content and subject.
+
+    :param message: message dict for `send`
+    :param substitutions: placeholders and values for the recipient
+    """
+    headers = dict()
+    for header, value in message.get("headers", {}).items():
+        personal_value = value
+        for placeholder, replacement in substitutions.items():
+            personal_value = personal_value.replace(placeholder, replacement)
+        if personal_value != value:
+            headers[header] = personal_value
+    return headers
+
+
+def get_recipients(email_name):
+    """
+    Get recipients of Email Queue with their status.
+
+    :param email_name: name of Email Queue
+    """
+    return frappe.db.sql("""select name, recipient, status from `tabEmail Queue Recipient`
+        where parent=%s""", email_name, as_dict=True)
+
+
+def set_sent(email_name, recipients):
+    """
+    Mark recipients of Email Queue sent and commit, so they are not sent again if the
+    job is killed before Frappe marks them.
+
+    :param email_name: name of Email Queue
+    :param recipients: list of recipient dicts of `send`
+    """
+    emails = [email for recipient in recipients
+              for email in recipient["to"] + recipient.get("cc", [])]
+    frappe.db.sql("""update `tabEmail Queue Recipient` set status='Sent', modified=%s
+        where parent=%s and status='Not Sent' and recipient in ({})""".format(
+        ", ".join(["%s"] * len(emails))), [now_datetime(), email_name] + emails)
+    frappe.db.commit()
+
+
+def get_web_api_account(sender):
+    """
+    Get Email Account document that sends emails of sender with SendGrid Web API, None
+    for other senders. Accounts are loaded once per job.
+
+    :param sender: sender of the email
+    """
+    if not hasattr(frappe.local, "sendgrid_web_api_accounts"):
+        frappe.local.sendgrid_web_api_accounts = dict(
+            (email_account.email_id.lower(), frappe.get_doc("Email Account",
+                                                            email_account.name))
+            for email_account in frappe.get_all("Email Account",
+                                                filters={"service": "SendGrid",
+                                                         "enable_outgoing": 1,
+                                                         "sendgrid_use_web_api": 1},
+                                                fields=["name", "email_id", "api_key"])
+            if email_account.api_key and email_account.email_id)
+
+    return frappe.local.sendgrid_web_api_accounts.get(parseaddr(sender)[1].lower())
+
+
+def send_smtp(email, sender, recipient, message):
+    """
+    Send one recipient of Email Queue over SMTP with Email Account Frappe picks for it.
+
+    SMTP session is opened for the first recipient of Email Queue and reused for the
+    rest of its recipients, it is quit after the last one or when sending fails.
+
+    :param email: Email Queue being sent
+    :param sender: sender of the email
+    :param recipient: recipient email address
+    :param message: MIME message prepared for the recipient
+    """
+    session = getattr(frappe.local, "sendgrid_smtp_session", None)
+    if not session or session.email != email.name:
+        quit_smtp_session()
+        smtp_server = SMTPServer()
+        smtp_server.setup_email_account(email.reference_doctype, sender=sender)
+        session = frappe.local.sendgrid_smtp_session = frappe._dict(
+            email=email.name, smtp_server=smtp_server, connected=False,
+            pending=set(r.recipient for r in get_recipients(email.name)
+                        if r.status == "Not Sent"))
+
+    try:
+        sess = session.smtp_server.sess
+        session.connected = True
+        sess.sendmail(sender, recipient, encode(message))
+    except Exception:
+        quit_smtp_session()
+        raise
+
+    session.pending.discard(recipient)
+    if not session.pending:
+        quit_smtp_session()
+
+
+def quit_smtp_session():
+    """Quit SMTP session opened by `send_smtp`."""
+    session = getattr(frappe.local, "sendgrid_smtp_session", None)
+    if not session:
+        return
+
+    del frappe.local.sendgrid_smtp_session
+    if session.connected:
+        try:
+            session.smtp_server.sess.quit()
+        except (smtplib.SMTPException, socket.error):
+            pass
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, Semilimes
+# For license information, please see license.txt
+
+import re
+import time
+import threading
+from collections import defaultdict
+
+import frappe
+
+
+METRICS_KEY = "sendgrid_metrics"
+
+# seconds between flushes of process metrics to Redis
+FLUSH_INTERVAL = 10
+
+# seconds spent in stages of webhook handling and blacklist sync
+STAGE_SECONDS = "sendgrid_stage_seconds"
+# database queries run in stages
+DB_QUERIES = "sendgrid_db_queries_total"
+
+METRIC_DESCRIPTIONS = {
+    "sendgrid_stage_seconds": "Seconds spent in stages of SendGrid integration",
+    "sendgrid_db_queries_total": "Database queries run in stages of SendGrid integration",
+    "sendgrid_webhook_requests_total": "SendGrid webhook requests received",
+    "sendgrid_webhook_auth_failures_total": "SendGrid webhook requests failed to authenticate",
+    "sendgrid_webhook_events_total": "SendGrid webhook events applied",
+    "sendgrid_routed_events_total": "SendGrid webhook events sent to other sites",
+    "sendgrid_communication_cache_hits_total": "Communications found in worker cache",
+    "sendgrid_communication_cache_misses_total": "Communications fetched from database",
+    "sendgrid_http_seconds": "Seconds spent in requests to SendGrid API",
+    "sendgrid_http_requests_total": "Requests to SendGrid API by method and status",
+    "sendgrid_http_retries_total": "Retried connections to SendGrid API",
+    "sendgrid_http_rate_limited_total": "Requests to SendGrid API answered with 429",
+    "sendgrid_http_errors_total": "Failed requests to SendGrid API",
+}
+
+SAMPLE = re.compile(r"^([a-z_]+?)(_sum|_count)?(\{.*\})?$")
+
+_registries = dict()
+_registries_lock = threading.Lock()
+
+
+class Registry(object):
+    """
+    Metrics of one site recorded by this process.
+
+    Values are kept in memory and added to Redis hash `METRICS_KEY` every
+    `FLUSH_INTERVAL` seconds, so metrics of all web and background workers are summed.
+    """
+
+    def __init__(self):
+        self.values = defaultdict(float)
+        self.flushed = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, sample, value):
+        with self.lock:
+            self.values[sample] += value
+
+        if time.time() - self.flushed >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            values, self.values = self.values, defaultdict(float)
+            self.flushed = time.time()
+
+        if values:
+            cache = frappe.cache()
+            key = cache.make_key(METRICS_KEY)
+            pipeline = cache.pipeline()
+            for sample, value in values.items():
+                pipeline.hincrbyfloat(key, sample, value)
+            pipeline.execute()
+
+
+class Timer(object):
+    """
+    Context manager that observes seconds spent in its block.
+
+    Queries run via `frappe.db.sql` in a block with `stage` label are counted as
+    `DB_QUERIES` of the stage.
+    """
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.stage = labels.get("stage")
+        self.outer_stage = None
+        self.started = None
+
+    def __enter__(self):
+        if self.stage:
+            count_queries()
+            self.outer_stage = getattr(frappe.local, "sendgrid_stage", None)
+            frappe.local.sendgrid_stage = self.stage
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *args):
+        observe(self.name, time.time() - self.started, **self.labels)
+        if self.stage:
+            frappe.local.sendgrid_stage = self.outer_stage
+
+
+class NoopTimer(object):
+    """Timer used while metrics are disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_noop_timer = NoopTimer()
+
+
+def enabled():
+    """Metrics are recorded when `sendgrid_metrics` is set in site config."""
+    return bool(frappe.conf.sendgrid_metrics)
+
+
+def get_registry():
+    site = frappe.local.site
+    registry = _registries.get(site)
+    if not registry:
+        with _registries_lock:
+            registry = _registries.setdefault(site, Registry())
+    return registry
+
+
+def get_sample(name, labels):
+    if not labels:
+        return name
+    return "{}{{{}}}".format(name, ",".join(
+        '{}="{}"'.format(label, str(value).replace('"', "'"))
+        for label, value in sorted(labels.items())))
+
+
+def incr(name, value=1, **labels):
+    """
+    Increase counter.
+
+    :param name: name of the counter, should end with `_total`
+    :param value: value to add
+    :param labels: Prometheus labels of the counter
+    """
+    if enabled():
+        get_registry().add(get_sample(name, labels), value)
+
+
+def observe(name, seconds, **labels):
+    """
+    Add observed duration to summary `name`, i.e. to its `_sum` and `_count`.
+
+    :param name: name of the summary, should end with `_seconds`
+    :param seconds: observed duration
+    :param labels: Prometheus labels of the summary
+    """
+    if enabled():
+        registry = get_registry()
+        registry.add(get_sample(name + "_sum", labels), seconds)
+        registry.add(get_sample(name + "_count", labels), 1)
+
+
+def timer(name, **labels):
+    """
+    Get context manager that observes seconds spent in its block, see `Timer`.
+
+    :param name: name of the summary, should end with `_seconds`
+    :param labels: Prometheus labels of the summary
+    """
+    if not enabled():
+        return _noop_timer
+    return Timer(name, labels)
+
+
+def stage(name):
+    """
+    Get context manager that observes seconds and queries of a stage, e.g. 'auth'.
+
+    :param name: name of the stage
+    """
+    return timer(STAGE_SECONDS, stage=name)
+
+
+def count_queries():
+    """Wrap `frappe.db.sql` of the current connection to count queries of stages."""
+    db = frappe.db
+    if getattr(db, "sendgrid_sql", None):
+        return
+
+    sql = db.sql
+
+    def counted_sql(*args, **kwargs):
+        current_stage = getattr(frappe.local, "sendgrid_stage", None)
+        if current_stage:
+            incr(DB_QUERIES, stage=current_stage)
+        return sql(*args, **kwargs)
+
+    db.sendgrid_sql = sql
+    db.sql = counted_sql
+
+
+def flush():
+    """Add metrics recorded by this process to Redis, e.g. before a background job ends."""
+    if enabled():
+        get_registry().flush()
+
+
+def get_values():
+    """Get metrics of all processes as dict of Prometheus sample and value."""
+    flush()
+    cache = frappe.cache()
+    # RedisWrapper.hgetall prefixes the key and unpickles values, pipeline is not wrapped
+    values = cache.pipeline().hgetall(cache.make_key(METRICS_KEY)).execute()[0] or {}
+    return dict((frappe.as_unicode(sample), float(value))
+                for sample, value in values.items())
+
+
+@frappe.whitelist()
+def get_metrics():
+    """Get metrics as dict of Prometheus sample and value."""
+    frappe.only_for("System Manager")
+    return get_values()
+
+
+@frappe.whitelist()
+def get_metrics_text():
+    """Get metrics in Prometheus text format, for scraping with System Manager token."""
+    frappe.only_for("System Manager")
+
+    lines = list()
+    described = set()
+    for sample, value in sorted(get_values().items()):
+        name, suffix, labels = SAMPLE.match(sample).groups()
+        if name not in described:
+            described.add(name)
+            lines.append("# HELP {} {}".format(name, METRIC_DESCRIPTIONS.get(name, name)))
+            lines.append("# TYPE {} {}".format(name, "summary" if suffix else "counter"))
+        lines.append("{} {}".format(sample, repr(value)))
+
+    frappe.response["type"] = "txt"
+    frappe.response["doctype"] = "sendgrid_metrics"
+    frappe.response["result"] = "\n".join(lines) + "\n"
+
+
+@frappe.whitelist()
+def reset_metrics():
+    """Clear metrics of all processes."""
+    frappe.only_for("System Manager")
+    frappe.cache().delete(frappe.cache().make_key(METRICS_KEY))
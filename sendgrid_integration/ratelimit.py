@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, Semilimes
+# For license information, please see license.txt
+
+import time
+import threading
+
+
+# requests per second allowed until SendGrid reports its limits
+DEFAULT_RATE = 10
+# seconds to wait after 429 response without rate limit headers
+DEFAULT_BACKOFF = 1
+
+
+class TokenBucket(object):
+    """
+    Token bucket that paces requests to SendGrid API endpoint.
+
+    Bucket is refilled at `rate` tokens per second up to `capacity`, every request takes
+    one token. Rate and capacity follow X-RateLimit-* headers of SendGrid responses, when
+    the limit is reached no tokens are given until the reset time.
+
+    :param rate: tokens added per second
+    :param capacity: maximum number of tokens
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, capacity=DEFAULT_RATE):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        self.resume_at = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        if self.resume_at:
+            if now < self.resume_at:
+                return
+            # new rate limit window started
+            self.resume_at = 0
+            self.tokens = float(self.capacity)
+        else:
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """Get seconds to wait until the next request is allowed."""
+        with self.lock:
+            now = time.time()
+            self._refill(now)
+            if self.resume_at:
+                return self.resume_at - now
+            if self.tokens >= 1:
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self, max_wait=None):
+        """
+        Wait until request is allowed and take a token.
+
+        Returns False without waiting when the request would be allowed only after more
+        than `max_wait` seconds.
+
+        :param max_wait: maximum number of seconds to wait
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self._refill(now)
+                if not self.resume_at and self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+
+            delay = self.delay()
+            if max_wait is not None and delay > max_wait:
+                return False
+
+            time.sleep(delay)
+            if max_wait is not None:
+                max_wait -= delay
+
+    def update(self, response):
+        """
+        Adjust the bucket to rate limit reported in response headers.
+
+        :param response: HTTP response of SendGrid API
+        """
+        headers = response.headers
+        try:
+            limit = int(headers.get("X-RateLimit-Limit") or 0)
+            remaining = int(headers["X-RateLimit-Remaining"])
+            reset = float(headers["X-RateLimit-Reset"])
+        except (KeyError, TypeError, ValueError):
+            if response.status_code == 429:
+                with self.lock:
+                    self.resume_at = time.time() + DEFAULT_BACKOFF
+            return
+
+        with self.lock:
+            now = time.time()
+            self._refill(now)
+            if limit:
+                self.capacity = limit
+
+            if remaining <= 0 or response.status_code == 429:
+                self.tokens = 0
+                self.resume_at = max(reset, now + DEFAULT_BACKOFF)
+            else:
+                self.tokens = min(self.tokens, remaining)
+                # spread the remaining requests evenly over the rest of the window
+                if reset > now:
+                    self.rate = max(remaining / (reset - now), 1.0 / DEFAULT_BACKOFF)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, Semilimes
+# For license information, please see license.txt
+
+import os
+import re
+import json
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+
+import frappe
+
+from . import event_queue, metrics
+
+
+# number of sites events are sent to concurrently, can be overridden in site config
+ROUTER_THREADS = 4
+
+# site names are used as directory names, anything else in message id is ignored
+SITE_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]*$")
+
+
+def get_site(message_id):
+    """
+    Get site name from message id in format '<communication@site>'.
+
+    :param message_id: unique message id received from webhook request
+    """
+    if message_id and "@" in message_id:
+        return message_id.strip(" <>").split("@", 1)[1]
+
+
+def is_bench_site(site):
+    """
+    Check that site exists in the bench of the current site.
+
+    :param site: site name
+    """
+    return bool(SITE_NAME.match(site)) and os.path.isfile(
+        os.path.join(frappe.local.sites_path, site, "site_config.json"))
+
+
+def route_events(events):
+    """
+    Send events of other sites of the bench to these sites and return the rest.
+
+    Events are grouped by site in message id, every site gets its group with one
+    connection: events are queued when `sendgrid_webhook_queue` is set in config of the
+    site and applied right away otherwise. Events of unknown sites are returned with
+    events of the current site and skipped later.
+
+    Raises exception when events failed to be sent to some site, so SendGrid retries the
+    request. Events applied already are dropped by the retry as duplicates.
+
+    :param events: list of compact SendGrid events
+    """
+    local_events = list()
+    site_events = defaultdict(list)
+    for event in events:
+        site = get_site(event.get("message_id"))
+        if site and site != frappe.local.site and is_bench_site(site):
+            site_events[site].append(event)
+        else:
+            local_events.append(event)
+
+    if not site_events:
+        return local_events
+
+    threads = frappe.conf.sendgrid_router_threads or ROUTER_THREADS
+    sites_path = frappe.local.sites_path
+    pool = ThreadPool(min(threads, len(site_events)))
+    try:
+        errors = pool.map(
+            lambda group: _send_to_site(group[0], sites_path, group[1]),
+            site_events.items())
+    finally:
+        pool.close()
+        pool.join()
+
+    errors = [error for error in errors if error]
+    for error in errors:
+        frappe.errprint(error)
+
+    if errors:
+        raise frappe.ValidationError("Failed to route SendGrid events to {} sites".format(
+            len(errors)))
+
+    metrics.incr("sendgrid_routed_events_total",
+                 sum(len(events) for events in site_events.values()))
+
+    return local_events
+
+
+def _send_to_site(site, sites_path, events):
+    """
+    Queue or apply events of one site in a separate thread with its own connection.
+
+    Returns error message, None on success.
+
+    :param site: site to send events to
+    :param sites_path: path of bench sites directory
+    :param events: list of compact SendGrid events of the site
+    """
+    from .webhook_events import process_events
+
+    frappe.init(site=site, sites_path=sites_path)
+    try:
+        frappe.connect()
+        if frappe.conf.sendgrid_webhook_queue:
+            if event_queue.push(json.dumps(events)) == 1:
+                frappe.enqueue("sendgrid_integration.webhook_events.drain_event_queue")
+        else:
+            process_events(events)
+    except Exception as e:
+        return "Failed to route SendGrid events to {}: {}".format(site, e)
+    finally:
+        frappe.destroy()
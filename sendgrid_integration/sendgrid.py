@@ -4,12 +4,56 @@
 
 import json
 import urllib
+import time
+import hashlib
+import threading
+import redis
 import requests
 from functools import wraps
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 import frappe
+from frappe.utils import cint
 
-from .account import global_unsubscribe_and_commit
+from . import metrics, suppression
+from .account import global_unsubscribe
+from .ratelimit import TokenBucket
+
+
+# SendGrid API url, can be overridden in site config e.g. to use a local stub
+API_URL = "https://api.sendgrid.com/v3/"
+
+# seconds webhook settings received from SendGrid are cached, can be overridden in site
+# config
+WEBHOOK_SETTINGS_TTL = 60 * 60
+
+# defaults for connections to SendGrid API, can be overridden in site config
+POOL_SIZE = 10
+# seconds to wait for connection and for response
+TIMEOUT = (5, 30)
+# retries of failed connections, delays grow as backoff factor * 2 ^ retry
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5
+
+# number of suppressed emails requested from SendGrid API at once
+PAGE_SIZE = 500
+
+# number of emails added to global suppressions with one request
+PUSH_BATCH_SIZE = 1000
+
+# seconds a sync may wait for SendGrid rate limit to reset before it stops
+MAX_RATE_LIMIT_WAIT = 900
+
+# seconds of overlap between incremental syncs, covers clock difference with SendGrid
+WATERMARK_OVERLAP = 300
+
+_clients = dict()
+_clients_lock = threading.Lock()
+
+# Email Unsubscribe records are checked for duplicates before insert, so concurrent
+# syncs of one process write them one at a time
+_unsubscribe_lock = threading.Lock()
 
 
 def api_url(api_endpoint):
@@ -18,7 +62,8 @@ def api_url(api_endpoint):
 
     :param api_endpoint: SendGrid API endpoint, will be appended to API url
     """
-    return urllib.basejoin('https://api.sendgrid.com/v3/', api_endpoint.lstrip("/"))
+    return urllib.basejoin(frappe.conf.sendgrid_api_url or API_URL,
+                           api_endpoint.lstrip("/"))
 
 
 def auth_header(api_key):
@@ -30,13 +75,130 @@ def auth_header(api_key):
     return {"Authorization": "Bearer {}".format(api_key)}
 
 
+class SendGridClient(object):
+    """
+    Client for SendGrid API that keeps pooled keep-alive connections for one API key.
+
+    :param api_key: SendGrid API key, should be generated in SendGrid settings
+    :param pool_size: maximum number of connections kept open
+    :param timeout: seconds to wait for connection and for response
+    :param max_retries: number of retries of failed connections
+    :param backoff_factor: delay between retries grows as backoff factor * 2 ^ retry
+    """
+
+    def __init__(self, api_key, pool_size=POOL_SIZE, timeout=TIMEOUT,
+                 max_retries=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR):
+        self.timeout = timeout
+
+        # only connection errors are retried, request could have reached SendGrid otherwise
+        retry = Retry(total=max_retries, connect=max_retries, read=False,
+                      backoff_factor=backoff_factor)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.headers.update(auth_header(api_key))
+        self.session.mount("https://", adapter)
+
+        self.rate_limiters = dict()
+        self.rate_limiters_lock = threading.Lock()
+
+    def get_rate_limiter(self, api_endpoint):
+        """
+        Get token bucket that paces requests to API endpoint.
+
+        SendGrid rate limits are applied per endpoint, so requests to e.g. every
+        '/asm/suppressions/global/<email>' should share the bucket of
+        '/asm/suppressions/global'.
+
+        :param api_endpoint: SendGrid API endpoint
+        """
+        with self.rate_limiters_lock:
+            if api_endpoint not in self.rate_limiters:
+                self.rate_limiters[api_endpoint] = TokenBucket()
+            return self.rate_limiters[api_endpoint]
+
+    def request(self, method, api_endpoint, **kwargs):
+        """
+        Send request to SendGrid API.
+
+        :param method: HTTP method
+        :param api_endpoint: SendGrid API endpoint, will be appended to API url
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        if not metrics.enabled():
+            return self.session.request(method, api_url(api_endpoint), **kwargs)
+
+        started = time.time()
+        try:
+            response = self.session.request(method, api_url(api_endpoint), **kwargs)
+        except requests.RequestException:
+            metrics.incr("sendgrid_http_errors_total", method=method)
+            raise
+        finally:
+            metrics.observe("sendgrid_http_seconds", time.time() - started, method=method)
+
+        metrics.incr("sendgrid_http_requests_total", method=method,
+                     status=response.status_code)
+        if response.status_code == 429:
+            metrics.incr("sendgrid_http_rate_limited_total", method=method)
+
+        # connection retries done by urllib3 are recorded in the raw response
+        retries = getattr(response.raw, "retries", None)
+        if retries and retries.history:
+            metrics.incr("sendgrid_http_retries_total", len(retries.history),
+                         method=method)
+
+        return response
+
+    def get(self, api_endpoint, **kwargs):
+        return self.request("GET", api_endpoint, **kwargs)
+
+    def post(self, api_endpoint, **kwargs):
+        return self.request("POST", api_endpoint, **kwargs)
+
+    def patch(self, api_endpoint, **kwargs):
+        return self.request("PATCH", api_endpoint, **kwargs)
+
+    def delete(self, api_endpoint, **kwargs):
+        return self.request("DELETE", api_endpoint, **kwargs)
+
+
+def get_client(api_key):
+    """
+    Get SendGrid API client for API key, client is created once per process.
+
+    Connection settings are taken from site config keys `sendgrid_pool_size`,
+    `sendgrid_timeout`, `sendgrid_max_retries` and `sendgrid_backoff_factor`.
+
+    :param api_key: SendGrid API key, should be generated in SendGrid settings
+    """
+    client = _clients.get(api_key)
+    if client:
+        return client
+
+    with _clients_lock:
+        if api_key not in _clients:
+            timeout = frappe.conf.sendgrid_timeout or TIMEOUT
+            _clients[api_key] = SendGridClient(
+                api_key,
+                pool_size=frappe.conf.sendgrid_pool_size or POOL_SIZE,
+                timeout=tuple(timeout) if isinstance(timeout, list) else timeout,
+                max_retries=frappe.conf.get("sendgrid_max_retries", MAX_RETRIES),
+                backoff_factor=frappe.conf.get("sendgrid_backoff_factor",
+                                               BACKOFF_FACTOR))
+
+        return _clients[api_key]
+
+
 def handle_http_error(response):
     """
     Check HTTP response for errors and process them accordingly.
 
     :param response: HTTP response to check
     """
-    if response.status_code != 200:
+    # DELETE requests are answered with 204 No Content
+    if not 200 <= response.status_code < 300:
         # check if there is some info about error in json format
         if response.headers.get("content-type") == "application/json":
             error_json = response.json().get("errors")
@@ -61,45 +223,46 @@ def handle_request_errors(request_method):
             return request_method(*args, **kwargs)
         except requests.ConnectionError:
             frappe.errprint("Failed to connect to SendGrid API")
+        except requests.Timeout:
+            frappe.errprint("SendGrid API request timed out")
         except Exception as e:
             frappe.errprint("SendGrid API Request Error: {}".format(e.message))
     return safe_request_method
 
 
-@handle_request_errors
-def webhook_exists(api_key, webhook_post_url):
+def get_webhook_settings_key(api_key):
     """
-    Use SendGrid API to find out if webhook exists already.
+    Get cache key of webhook settings of API key.
 
     :param api_key: SendGrid API key, should be generated in SendGrid settings
-    :param webhook_post_url: full url for SendGrid webhook with credentials
-
-    Response JSON data example from
-    https://sendgrid.com/docs/API_Reference/Web_API_v3/Webhooks/event.html
-
-    {
-        "enabled": true,
-        "url": "url",
-        "group_resubscribe": true,
-        "delivered": true,
-        "group_unsubscribe": true,
-        "spam_report": true,
-        "bounce": true,
-        "deferred": true,
-        "unsubscribe": true,
-        "processed": true,
-        "open": true,
-        "click": true,
-        "dropped": true
-    }
-    """
-    r = requests.get(api_url("/user/webhooks/event/settings"),
-                     headers=auth_header(api_key))
+    """
+    return "sendgrid_webhook_settings|{}".format(hashlib.md5(api_key).hexdigest())
 
-    if handle_http_error(r):
-        return
 
-    return _webhook_enabled(r.json(), webhook_post_url)
+def get_webhook_settings(api_key, refresh=False):
+    """
+    Get event webhook settings of API key, settings are cached for
+    `sendgrid_webhook_settings_ttl` seconds (site config).
+
+    Returns None when SendGrid responds with error.
+
+    :param api_key: SendGrid API key, should be generated in SendGrid settings
+    :param refresh: request settings from SendGrid even if they are cached
+    """
+    cache = frappe.cache()
+    key = get_webhook_settings_key(api_key)
+    settings = None if refresh else cache.get_value(key)
+
+    if settings is None:
+        r = get_client(api_key).get("/user/webhooks/event/settings")
+        if handle_http_error(r):
+            return
+
+        settings = r.json()
+        cache.set_value(key, settings, expires_in_sec=frappe.conf.get(
+            "sendgrid_webhook_settings_ttl", WEBHOOK_SETTINGS_TTL))
+
+    return settings
 
 
 def _webhook_enabled(settings, webhook_post_url):
@@ -123,6 +286,9 @@ def add_webhook(api_key, webhook_post_url):
 
     More on SendGrid webhooks here:
     https://sendgrid.com/docs/API_Reference/Webhooks/event.html
+
+    Settings are only sent when they differ from cached settings of SendGrid, nothing
+    is sent when webhook is set up already.
     """
     webhook_settings = {"enabled": True,
                         "url": webhook_post_url,
@@ -139,21 +305,199 @@ def add_webhook(api_key, webhook_post_url):
                         "dropped": True,
                         }
 
-    r = requests.patch(api_url("/user/webhooks/event/settings"),
-                       data=json.dumps(webhook_settings),
-                       headers=auth_header(api_key))
+    remote_settings = get_webhook_settings(api_key)
+    if remote_settings is None:
+        return
+
+    if all(remote_settings.get(setting) == value
+           for setting, value in webhook_settings.items()):
+        return True
+
+    # SendGrid expects all settings, missing ones are disabled
+    r = get_client(api_key).patch("/user/webhooks/event/settings",
+                                  data=json.dumps(webhook_settings))
 
     if handle_http_error(r):
+        # cached settings could be outdated
+        frappe.cache().delete_value(get_webhook_settings_key(api_key))
+        return
+
+    remote_settings = r.json()
+    frappe.cache().set_value(get_webhook_settings_key(api_key), remote_settings,
+                             expires_in_sec=frappe.conf.get(
+                                 "sendgrid_webhook_settings_ttl", WEBHOOK_SETTINGS_TTL))
+
+    return _webhook_enabled(remote_settings, webhook_post_url)
+
+
+class SuppressionPager(object):
+    """
+    Iterate over suppression list of SendGrid API endpoint page by page.
+
+    Yields lists of at most `limit` emails, next page is requested only after the
+    previous one is processed. Processed emails are expected to be removed from the list
+    by the caller, emails that stay in the list should be reported with `keep` so they are
+    skipped when the next page is requested.
+
+    :param client: SendGrid API client, see `get_client`
+    :param endpoint: API endpoint to use in order to get list of emails
+    :param offset: number of emails to skip at the beginning of the list
+    :param limit: maximum number of emails in one page
+    :param start_time: unix timestamp, only emails added to the list since then are
+                       requested
+    """
+
+    def __init__(self, client, endpoint, offset=0, limit=PAGE_SIZE, start_time=None):
+        self.client = client
+        self.endpoint = endpoint
+        self.offset = offset
+        self.limit = limit
+        self.start_time = start_time
+        self.failed = False
+
+    def __iter__(self):
+        while True:
+            params = {"limit": self.limit, "offset": self.offset}
+            if self.start_time:
+                params["start_time"] = self.start_time
+
+            r = self.client.get(self.endpoint, params=params)
+
+            # process errors
+            if handle_http_error(r):
+                self.failed = True
+                return
+
+            emails = [item["email"] for item in r.json()]
+            if not emails:
+                return
+
+            yield emails
+
+            if len(emails) < self.limit:
+                return
+
+    def keep(self, count):
+        """
+        Skip emails that stay in the list when requesting the next page.
+
+        :param count: number of emails of the last page that were not removed
+        """
+        self.offset += count
+
+
+def get_sync_key(name, api_key, endpoint):
+    """
+    Get key of global default that keeps state of suppression list sync.
+
+    :param name: name of state, e.g. 'checkpoint' or 'watermark'
+    :param api_key: SendGrid API key, should be generated in SendGrid settings
+    :param endpoint: API endpoint to use in order to get list of emails
+    """
+    return "sendgrid_{}:{}".format(
+        name, hashlib.md5("{}:{}".format(api_key, endpoint)).hexdigest())
+
+
+def get_pending_deletions_key(api_key, remove_endpoint):
+    """
+    Get cache key of the queue of emails waiting for removal from SendGrid list.
+
+    :param api_key: SendGrid API key, should be generated in SendGrid settings
+    :param remove_endpoint: API endpoint to use in order to remove email from list
+    """
+    return get_sync_key("pending_deletions", api_key, remove_endpoint)
+
+
+def queue_deletions(api_key, remove_endpoint, emails):
+    """
+    Add emails to the persistent queue of emails to remove from SendGrid list.
+
+    :param api_key: SendGrid API key, should be generated in SendGrid settings
+    :param remove_endpoint: API endpoint to use in order to remove email from list
+    :param emails: emails to remove
+    """
+    if not emails:
         return
 
-    return _webhook_enabled(r.json(), webhook_post_url)
+    # RedisWrapper list methods prefix the key themselves and push one value, Redis
+    # methods are used with the prefixed key instead
+    cache = frappe.cache()
+    redis.Redis.rpush(cache,
+                      cache.make_key(get_pending_deletions_key(api_key, remove_endpoint)),
+                      *emails)
+
+
+def delete_pending(client, api_key, remove_endpoint, deadline):
+    """
+    Remove queued emails from SendGrid list one by one, pacing requests to rate limit.
+
+    When rate limit is reached, deletion waits for it to reset unless that would take
+    longer than the deadline, emails stay queued for the next run then. Every email is
+    claimed with atomic LPOP, so concurrent runs don't remove the same email; email of a
+    run that dies before removing it stays in SendGrid list and is requested again.
+
+    Returns whether the queue was emptied and number of emails that failed to be removed.
+
+    :param client: SendGrid API client, see `get_client`
+    :param api_key: SendGrid API key, should be generated in SendGrid settings
+    :param remove_endpoint: API endpoint to use in order to remove email from list
+    :param deadline: time after which deletion should not wait for rate limit reset
+    """
+    cache = frappe.cache()
+    queue_key = cache.make_key(get_pending_deletions_key(api_key, remove_endpoint))
+    rate_limiter = client.get_rate_limiter(remove_endpoint)
+    failed = 0
+
+    email = None
+    while True:
+        if email is None:
+            email = redis.Redis.lpop(cache, queue_key)
+            if email is None:
+                return True, failed
+
+        if not rate_limiter.acquire(max_wait=max(deadline - time.time(), 0)):
+            # return the claimed email to the queue for the next run
+            left = redis.Redis.lpush(cache, queue_key, email)
+            msg = "SendGrid request rate limit reached for {}, {} emails left".format(
+                remove_endpoint, left)
+            frappe.errprint(msg)
+            return False, failed
+
+        # remove from SendGrid list
+        email_removal_url = "{}/{}".format(remove_endpoint.rstrip("/"),
+                                           urllib.quote_plus(email))
+        r = client.delete(email_removal_url)
+        rate_limiter.update(r)
+
+        # retry the same email after rate limit reset
+        if r.status_code == 429:
+            continue
+
+        # process errors, email could be removed already
+        if r.status_code != 404 and handle_http_error(r):
+            failed += 1
+
+        email = None
 
 
 @handle_request_errors
-def unsubscribe_emails(api_key, endpoint, batch_key="emails", remove_endpoint=None):
+def unsubscribe_emails(api_key, endpoint, batch_key="emails", remove_endpoint=None,
+                       full_sync=False):
     """
     Receive list of emails from SendGrid and unsubscribe each email.
 
+    Emails are received page by page, every page is unsubscribed and removed from
+    SendGrid before the next one is requested. Position in the list is saved after every
+    page, so interrupted run continues where it stopped.
+
+    Only emails added to the list since the last complete run are requested, unless
+    full sync is requested.
+
+    Individual deletions are paced to SendGrid rate limit and queued persistently, the
+    queue left by an interrupted run is processed first. Emails unsubscribed in Frappe
+    are not removed individually, they are kept in SendGrid global suppressions where
+    `push_unsubscribes` added them.
+
     :param api_key: SendGrid API key, should be generated in SendGrid settings
     :param endpoint: API endpoint to use in order to get list of emails
     :param batch_key: key to group emails and perform batch deletion with one request. If
@@ -161,49 +505,143 @@ def unsubscribe_emails(api_key, endpoint, batch_key="emails", remove_endpoint=No
     :param remove_endpoint: API endpoint to use in order to remove email from list. If
                             not present - endpoint for retrieval will be used as removal
                             endpoint.
+    :param full_sync: request the whole list instead of emails added since the last run
     """
     if not remove_endpoint:
         remove_endpoint = endpoint
 
-    header = auth_header(api_key)
-    r = requests.get(api_url(endpoint), headers=header)
+    client = get_client(api_key)
+    checkpoint_key = get_sync_key("checkpoint", api_key, endpoint)
+    watermark_key = get_sync_key("watermark", api_key, endpoint)
+    deadline = time.time() + (frappe.conf.sendgrid_max_rate_limit_wait or
+                              MAX_RATE_LIMIT_WAIT)
 
-    # process errors
-    if handle_http_error(r):
-        return
+    if not batch_key:
+        emptied, failed = delete_pending(client, api_key, remove_endpoint, deadline)
+        if not emptied:
+            return
 
-    emails = [item["email"] for item in r.json()]
+    # emails added while this run is in progress will be requested by the next one
+    sync_started = int(time.time()) - WATERMARK_OVERLAP
+    pager = SuppressionPager(client, endpoint,
+                             offset=cint(frappe.db.get_global(checkpoint_key)),
+                             limit=frappe.conf.sendgrid_page_size or PAGE_SIZE,
+                             start_time=None if full_sync else cint(
+                                 frappe.db.get_global(watermark_key)))
+
+    for emails in pager:
+        # mark emails as unsubscribed in erpnext
+        with _unsubscribe_lock:
+            global_unsubscribe(emails, commit=True, imported=True)
+        suppression.add(emails)
+
+        # unsubscribe and remove
+        if batch_key:
+            # perform batch request
+            request_data = json.dumps({batch_key: emails})
+            r = client.delete(endpoint, data=request_data)
+            if handle_http_error(r):
+                return
+        else:
+            # perform deletion request for each email
+            local_unsubscribes = get_local_unsubscribes(emails)
+            queue_deletions(api_key, remove_endpoint,
+                            [email for email in emails
+                             if email.lower() not in local_unsubscribes])
+            emptied, failed = delete_pending(client, api_key, remove_endpoint, deadline)
+            pager.keep(failed + len(local_unsubscribes))
+
+            if not emptied:
+                # queued emails will be removed first next time
+                frappe.db.set_global(checkpoint_key, pager.offset)
+                frappe.db.commit()
+                return
+
+        frappe.db.set_global(checkpoint_key, pager.offset)
+        frappe.db.commit()
+
+    if not pager.failed:
+        # whole list is processed, start from the beginning next time
+        frappe.db.set_global(checkpoint_key, None)
+        frappe.db.set_global(watermark_key, sync_started)
+        frappe.db.commit()
+
+
+def get_local_unsubscribes(emails):
+    """
+    Get emails globally unsubscribed in Frappe rather than imported from SendGrid, in
+    lowercase.
+
+    :param emails: list of email addresses
+    """
     if not emails:
-        return
+        return set()
 
-    # unsubscribe and remove
-    if batch_key:
-        # perform batch request
-        request_data = json.dumps({batch_key: emails})
-        r = requests.delete(api_url(endpoint), data=request_data, headers=header)
-        if handle_http_error(r):
+    return set(email.lower() for email in frappe.db.sql_list("""select email
+        from `tabEmail Unsubscribe`
+        where global_unsubscribe=1 and ifnull(sendgrid_imported, 0)=0
+            and email in ({0})""".format(", ".join(["%s"] * len(emails))), emails))
+
+
+@handle_request_errors
+def push_unsubscribes(api_key, endpoint="/asm/suppressions/global"):
+    """
+    Add emails globally unsubscribed in Frappe to SendGrid global suppressions.
+
+    Email Unsubscribe records created since the last run are sent in batches of
+    `sendgrid_push_batch_size` (site config) emails, pacing requests to SendGrid rate
+    limit. Position is saved after every batch, so interrupted run continues where it
+    stopped. Records created from SendGrid lists and events are marked as imported and
+    skipped, SendGrid knows these emails already.
+
+    :param api_key: SendGrid API key, should be generated in SendGrid settings
+    :param endpoint: API endpoint to use in order to add emails to global suppressions
+    """
+    client = get_client(api_key)
+    rate_limiter = client.get_rate_limiter(endpoint)
+    watermark_key = get_sync_key("push_watermark", api_key, endpoint)
+    deadline = time.time() + (frappe.conf.sendgrid_max_rate_limit_wait or
+                              MAX_RATE_LIMIT_WAIT)
+    batch_size = frappe.conf.sendgrid_push_batch_size or PUSH_BATCH_SIZE
+
+    # records are ordered by creation and name, so records created at the same time are
+    # not skipped between batches
+    creation, name = (frappe.db.get_global(watermark_key) or "|").split("|", 1)
+
+    while True:
+        unsubscribes = frappe.db.sql("""select name, email, creation
+            from `tabEmail Unsubscribe`
+            where global_unsubscribe=1 and ifnull(sendgrid_imported, 0)=0
+                and (creation > %(creation)s or (creation = %(creation)s and name > %(name)s))
+            order by creation, name
+            limit %(limit)s""", {"creation": creation or "1970-01-01 00:00:00",
+                                  "name": name,
+                                  "limit": batch_size}, as_dict=True)
+        if not unsubscribes:
             return
 
-        # mark emails as unsubscribed in erpnext
-        for email in emails:
-            global_unsubscribe_and_commit(email)
-    else:
-        # perform deletion request for each email
-        for email in emails:
-            global_unsubscribe_and_commit(email)
-
-            # remove from SendGrid list
-            email_removal_url = "{}/{}".format(remove_endpoint.rstrip("/"),
-                                               urllib.quote_plus(email))
-            r = requests.delete(api_url(email_removal_url), headers=header)
-
-            # check if rate limit reached
+        emails = list(set(unsubscribe.email.strip().lower()
+                          for unsubscribe in unsubscribes if unsubscribe.email))
+
+        while emails:
+            if not rate_limiter.acquire(max_wait=max(deadline - time.time(), 0)):
+                frappe.errprint("SendGrid request rate limit reached for {}".format(
+                    endpoint))
+                return
+
+            r = client.post(endpoint, data=json.dumps({"recipient_emails": emails}))
+            rate_limiter.update(r)
+
+            # retry the same batch after rate limit reset
             if r.status_code == 429:
-                msg = "SendGrid request rate limit reached for {}".format(
-                    remove_endpoint)
-                frappe.errprint(msg)
-                break
+                continue
 
-            # process errors
             if handle_http_error(r):
-                continue
+                return
+
+            suppression.add(emails)
+            break
+
+        creation, name = str(unsubscribes[-1].creation), unsubscribes[-1].name
+        frappe.db.set_global(watermark_key, "{}|{}".format(creation, name))
+        frappe.db.commit()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, Semilimes
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import json
+import hashlib
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import now, cint, getdate
+from redis.exceptions import ResponseError
+
+from sendgrid_integration.account import EVENT_TYPES
+from sendgrid_integration.sendgrid_integration.doctype.sendgrid_event.sendgrid_event \
+    import get_event_time
+
+
+COUNTERS_KEY = "sendgrid_engagement_counters"
+FLUSHING_KEY = "sendgrid_engagement_counters_flushing"
+
+
+class SendGridEngagement(Document):
+    pass
+
+
+def on_doctype_update():
+    """Add index for reading counters of period."""
+    frappe.db.add_index("SendGrid Engagement", ["date", "email_account"])
+
+
+def count_events(events, email_account=None):
+    """
+    Increment counters of events per Email Account, day and delivery status in Redis.
+
+    Events are counted per SendGrid category too when `sendgrid_count_categories` is set
+    in site config. Counters are saved to SendGrid Engagement by `flush_counters`.
+
+    :param events: list of SendGrid events received from webhook request
+    :param email_account: Email Account the webhook request was authenticated for
+    """
+    counters = dict()
+    count_categories = frappe.conf.sendgrid_count_categories
+
+    for event in events:
+        delivery_status = EVENT_TYPES.get(event.get("event"))
+        if not delivery_status:
+            continue
+
+        date = getdate(get_event_time(event.get("timestamp"))).isoformat()
+
+        categories = [None]
+        if count_categories and event.get("category"):
+            categories = event.get("category")
+            if not isinstance(categories, list):
+                categories = [categories]
+
+        for category in categories:
+            field = json.dumps([email_account, date, delivery_status, category])
+            counters[field] = counters.get(field, 0) + 1
+
+    if not counters:
+        return
+
+    cache = frappe.cache()
+    pipeline = cache.pipeline()
+    for field, count in counters.items():
+        pipeline.hincrby(cache.make_key(COUNTERS_KEY), field, count)
+    pipeline.execute()
+
+
+def flush_counters():
+    """
+    Add counters collected in Redis to SendGrid Engagement.
+
+    Counters are moved aside before they are saved, so events counted meanwhile are not
+    lost. Run via All Scheduler.
+    """
+    cache = frappe.cache()
+    counters_key = cache.make_key(COUNTERS_KEY)
+    flushing_key = cache.make_key(FLUSHING_KEY)
+
+    # counters left by a failed flush are saved first
+    if not cache.exists(flushing_key):
+        try:
+            cache.rename(counters_key, flushing_key)
+        except ResponseError:
+            # no counters
+            return
+
+    # RedisWrapper.hgetall prefixes the key and unpickles values, pipeline is not wrapped
+    counters = cache.pipeline().hgetall(flushing_key).execute()[0]
+    if counters:
+        timestamp = now()
+        user = frappe.session.user
+        values = list()
+        for field, count in counters.items():
+            email_account, date, delivery_status, category = json.loads(field)
+            name = hashlib.md5(field).hexdigest()[:10]
+            values.extend([name, timestamp, timestamp, user, user, email_account, date,
+                           delivery_status, category, int(count)])
+
+        frappe.db.sql("""insert into `tabSendGrid Engagement`
+            (name, creation, modified, owner, modified_by, docstatus, email_account, date,
+                delivery_status, category, count)
+            values {0}
+            on duplicate key update count=count + values(count), modified=values(modified)
+            """.format(", ".join(["(%s, %s, %s, %s, %s, 0, %s, %s, %s, %s, %s)"] *
+                                 len(counters))), values)
+        frappe.db.commit()
+
+    cache.delete(flushing_key)
+
+
+@frappe.whitelist()
+def get_engagement(from_date, to_date, email_account=None, by_category=False):
+    """
+    Get number of events per day and delivery status.
+
+    :param from_date: first day of the period
+    :param to_date: last day of the period
+    :param email_account: count events of this Email Account only
+    :param by_category: count events per SendGrid category too
+    """
+    frappe.only_for("System Manager")
+
+    conditions = ["date between %(from_date)s and %(to_date)s"]
+    if email_account:
+        conditions.append("email_account=%(email_account)s")
+
+    group_by = ["date", "delivery_status"]
+    if cint(by_category):
+        group_by.append("category")
+
+    return frappe.db.sql("""select {0}, sum(count) as count
+        from `tabSendGrid Engagement`
+        where {1}
+        group by {0}
+        order by date""".format(", ".join(group_by), " and ".join(conditions)),
+        {"from_date": getdate(from_date),
+         "to_date": getdate(to_date),
+         "email_account": email_account}, as_dict=True)
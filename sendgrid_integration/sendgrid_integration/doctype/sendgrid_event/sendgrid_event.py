@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, Semilimes
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+from datetime import datetime
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import (now, cint, add_days, nowdate, getdate,
+                          convert_utc_to_user_timezone)
+
+
+# days SendGrid events are kept, can be overridden in site config
+RETENTION_DAYS = 90
+
+# number of rows deleted at once when pruning
+PRUNE_CHUNK_SIZE = 10000
+
+# fields of SendGrid Event filled from webhook events
+EVENT_FIELDS = ("communication", "email", "event", "event_time", "email_account",
+                "sg_event_id")
+
+
+class SendGridEvent(Document):
+    pass
+
+
+def on_doctype_update():
+    """Add indexes for timeline of communication, events of email address and pruning."""
+    frappe.db.add_index("SendGrid Event", ["communication", "event_time"])
+    frappe.db.add_index("SendGrid Event", ["email", "event"])
+    frappe.db.add_index("SendGrid Event", ["event_time"])
+
+
+def get_event_time(timestamp):
+    """
+    Convert unix timestamp of SendGrid event to datetime in system time zone.
+
+    :param timestamp: unix timestamp received from webhook request
+    """
+    if not timestamp:
+        return now()
+
+    return convert_utc_to_user_timezone(
+        datetime.utcfromtimestamp(float(timestamp))).replace(tzinfo=None)
+
+
+def insert_events(events):
+    """
+    Append SendGrid events with one insert, without commit.
+
+    :param events: list of dicts with `EVENT_FIELDS`, `event_time` as unix timestamp
+    """
+    if not events:
+        return
+
+    timestamp = now()
+    user = frappe.session.user
+    values = list()
+    for event in events:
+        values.extend([frappe.generate_hash(length=10), timestamp, timestamp, user, user])
+        values.extend([get_event_time(event.get(field)) if field == "event_time"
+                       else event.get(field) for field in EVENT_FIELDS])
+
+    frappe.db.sql("""insert into `tabSendGrid Event`
+        (name, creation, modified, owner, modified_by, docstatus, {0})
+        values {1}""".format(
+        ", ".join(EVENT_FIELDS),
+        ", ".join(["(%s, %s, %s, %s, %s, 0, {0})".format(
+            ", ".join(["%s"] * len(EVENT_FIELDS)))] * len(events))),
+        values)
+
+
+def prune_events():
+    """
+    Delete SendGrid events older than `sendgrid_event_retention_days` (site config).
+
+    Run via Daily Scheduler.
+    """
+    retention_days = cint(frappe.conf.sendgrid_event_retention_days) or RETENTION_DAYS
+    before = add_days(nowdate(), -retention_days)
+
+    while True:
+        frappe.db.sql("""delete from `tabSendGrid Event`
+            where event_time < %s limit %s""", (before, PRUNE_CHUNK_SIZE))
+        deleted = frappe.db._cursor.rowcount
+        frappe.db.commit()
+
+        if deleted < PRUNE_CHUNK_SIZE:
+            break
+
+
+@frappe.whitelist()
+def get_timeline(communication):
+    """
+    Get SendGrid events of communication in order they happened.
+
+    :param communication: name of Communication
+    """
+    if not frappe.has_permission("Communication", doc=communication):
+        raise frappe.PermissionError
+
+    return frappe.db.sql("""select email, event, event_time
+        from `tabSendGrid Event`
+        where communication=%s
+        order by event_time""", communication, as_dict=True)
+
+
+@frappe.whitelist()
+def get_event_counts(from_date, to_date, group_by="day"):
+    """
+    Get number of SendGrid events of every type per day or per newsletter.
+
+    :param from_date: first day of the period
+    :param to_date: last day of the period
+    :param group_by: 'day' or 'newsletter'
+    """
+    frappe.only_for("System Manager")
+
+    period = (getdate(from_date), add_days(getdate(to_date), 1))
+
+    if group_by == "newsletter":
+        return frappe.db.sql("""select comm.reference_name as newsletter, event.event,
+                count(*) as count
+            from `tabSendGrid Event` event
+            inner join `tabCommunication` comm on comm.name=event.communication
+            where event.event_time >= %s and event.event_time < %s
+                and comm.reference_doctype='Newsletter'
+            group by comm.reference_name, event.event""", period, as_dict=True)
+
+    return frappe.db.sql("""select date(event_time) as date, event, count(*) as count
+        from `tabSendGrid Event`
+        where event_time >= %s and event_time < %s
+        group by date(event_time), event""", period, as_dict=True)
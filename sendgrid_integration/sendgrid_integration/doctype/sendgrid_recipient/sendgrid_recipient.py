@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, Semilimes
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import hashlib
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import now
+
+
+class SendGridRecipient(Document):
+    pass
+
+
+def on_doctype_update():
+    """Add index for statuses of communication."""
+    frappe.db.add_index("SendGrid Recipient", ["communication", "delivery_status"])
+
+
+def get_name(communication, email):
+    """
+    Get name of SendGrid Recipient, one record is kept per recipient of communication.
+
+    :param communication: name of Communication
+    :param email: normalized email address of recipient
+    """
+    return hashlib.md5("{}|{}".format(communication, email).encode("utf-8")).hexdigest()[:10]
+
+
+def set_recipient_statuses(recipients, delivery_status, higher_statuses):
+    """
+    Set the same delivery status for many recipients with one upsert, without commit.
+
+    :param recipients: list of Communication name and email pairs
+    :param delivery_status: delivery status to set
+    :param higher_statuses: statuses that should not be replaced by `delivery_status`
+    """
+    if not recipients:
+        return
+
+    timestamp = now()
+    user = frappe.session.user
+    values = list()
+    for communication, email in recipients:
+        values.extend([get_name(communication, email), timestamp, timestamp, user, user,
+                       communication, email, delivery_status])
+
+    frappe.db.sql("""insert into `tabSendGrid Recipient`
+        (name, creation, modified, owner, modified_by, docstatus, communication, email,
+            delivery_status)
+        values {0}
+        on duplicate key update
+            delivery_status=if(delivery_status in ({1}), delivery_status,
+                values(delivery_status)),
+            modified=values(modified)""".format(
+        ", ".join(["(%s, %s, %s, %s, %s, 0, %s, %s, %s)"] * len(recipients)),
+        ", ".join(["%s"] * len(higher_statuses))),
+        values + list(higher_statuses))
+
+
+def count_recipients(communications, delivery_statuses):
+    """
+    Count recipients of communications that have one of delivery statuses.
+
+    Returns dict of Communication name and number of recipients.
+
+    :param communications: names of Communication
+    :param delivery_statuses: delivery statuses to count
+    """
+    if not communications:
+        return dict()
+
+    return dict(frappe.db.sql("""select communication, count(*)
+        from `tabSendGrid Recipient`
+        where communication in ({0}) and delivery_status in ({1})
+        group by communication""".format(", ".join(["%s"] * len(communications)),
+                                          ", ".join(["%s"] * len(delivery_statuses))),
+        list(communications) + list(delivery_statuses)))
+
+
+@frappe.whitelist()
+def get_recipient_statuses(communication):
+    """
+    Get delivery status of every recipient of communication SendGrid reported about.
+
+    :param communication: name of Communication
+    """
+    if not frappe.has_permission("Communication", doc=communication):
+        raise frappe.PermissionError
+
+    return frappe.db.sql("""select email, delivery_status, modified
+        from `tabSendGrid Recipient`
+        where communication=%s
+        order by email""", communication, as_dict=True)
@@ -0,0 +1,61 @@
+frappe.pages['sendgrid-engagement'].on_page_load = function(wrapper) {
+	var page = frappe.ui.make_app_page({
+		parent: wrapper,
+		title: 'SendGrid Engagement',
+		single_column: true
+	});
+
+	frappe.breadcrumbs.add("Integrations");
+
+	var refresh = function() {
+		frappe.call({
+			method: "sendgrid_integration.sendgrid_integration.doctype.sendgrid_engagement.sendgrid_engagement.get_engagement",
+			args: {
+				from_date: page.fields_dict.from_date.get_value(),
+				to_date: page.fields_dict.to_date.get_value(),
+				email_account: page.fields_dict.email_account.get_value()
+			},
+			callback: function(r) {
+				render(r.message || []);
+			}
+		});
+	};
+
+	var render = function(rows) {
+		var statuses = [];
+		var dates = {};
+		$.each(rows, function(i, row) {
+			if (statuses.indexOf(row.delivery_status) === -1) {
+				statuses.push(row.delivery_status);
+			}
+			dates[row.date] = dates[row.date] || {};
+			dates[row.date][row.delivery_status] = row.count;
+		});
+
+		var html = '<table class="table table-bordered"><thead><tr><th>' + __("Date") + '</th>';
+		$.each(statuses, function(i, status) {
+			html += '<th>' + __(status) + '</th>';
+		});
+		html += '</tr></thead><tbody>';
+		$.each(Object.keys(dates).sort(), function(i, date) {
+			html += '<tr><td>' + frappe.datetime.str_to_user(date) + '</td>';
+			$.each(statuses, function(j, status) {
+				html += '<td>' + (dates[date][status] || 0) + '</td>';
+			});
+			html += '</tr>';
+		});
+		html += '</tbody></table>';
+
+		$(page.main).html(rows.length ? html :
+			'<p class="text-muted">' + __("No events in this period") + '</p>');
+	};
+
+	page.add_field({fieldname: "from_date", label: __("From Date"), fieldtype: "Date",
+		"default": frappe.datetime.add_days(frappe.datetime.get_today(), -30), change: refresh});
+	page.add_field({fieldname: "to_date", label: __("To Date"), fieldtype: "Date",
+		"default": frappe.datetime.get_today(), change: refresh});
+	page.add_field({fieldname: "email_account", label: __("Email Account"), fieldtype: "Link",
+		options: "Email Account", change: refresh});
+
+	refresh();
+}
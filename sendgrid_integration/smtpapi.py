@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, Semilimes
+# For license information, please see license.txt
+
+import json
+
+import frappe
+from frappe.utils import cint
+
+
+# serialized X-SMTPAPI header parts by site, Email Account name and modification time
+_templates = dict()
+
+
+def get_header(message_id, email_account=None):
+    """
+    Get X-SMTPAPI header value with message id as unique argument.
+
+    Settings of SendGrid Email Account (categories, unsubscribe group, IP pool and
+    tracking) are serialized once per account, only message id is added per message.
+
+    :param message_id: Message-Id of email
+    :param email_account: Email Account document email is sent from
+    """
+    prefix, suffix = get_header_template(email_account)
+    return prefix + json.dumps(message_id) + suffix
+
+
+def get_header_template(email_account=None):
+    """
+    Get X-SMTPAPI header value split around message id.
+
+    Template is cached until Email Account is modified.
+
+    :param email_account: Email Account document email is sent from
+    """
+    key = (frappe.local.site,
+           email_account.name if email_account else None,
+           email_account.modified if email_account else None)
+    template = _templates.get(key)
+
+    if not template:
+        settings = json.dumps(get_account_settings(email_account), sort_keys=True)
+        template = (settings[:-1] + (", " if settings != "{}" else "") +
+                    '"unique_args": {"message_id": ', "}}")
+
+        # drop templates of previous modifications
+        for cached_key in list(_templates):
+            if cached_key[:2] == key[:2]:
+                _templates.pop(cached_key, None)
+
+        _templates[key] = template
+
+    return template
+
+
+def get_account_settings(email_account=None):
+    """
+    Get X-SMTPAPI settings from SendGrid Email Account.
+
+    :param email_account: Email Account document email is sent from
+    """
+    settings = dict()
+    if not email_account or email_account.get("service") != "SendGrid":
+        return settings
+
+    categories = [category.strip()
+                  for category in (email_account.get("sendgrid_categories") or "").split("\n")
+                  if category.strip()]
+    if categories:
+        settings["category"] = categories
+
+    if cint(email_account.get("sendgrid_asm_group_id")):
+        settings["asm_group_id"] = cint(email_account.get("sendgrid_asm_group_id"))
+
+    if email_account.get("sendgrid_ip_pool"):
+        settings["ip_pool"] = email_account.get("sendgrid_ip_pool")
+
+    if email_account.get("sendgrid_tracking"):
+        enable = 1 if email_account.get("sendgrid_tracking") == "Enabled" else 0
+        settings["filters"] = {"opentrack": {"settings": {"enable": enable}},
+                               "clicktrack": {"settings": {"enable": enable}}}
+
+    return settings
+
+
+def clear_cache():
+    """Remove serialized X-SMTPAPI headers from cache."""
+    _templates.clear()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, Semilimes
+# For license information, please see license.txt
+
+import frappe
+
+from .account import chunked
+
+
+SUPPRESSED_KEY = "sendgrid_suppressed_emails"
+REBUILD_KEY = "sendgrid_suppressed_emails_rebuild"
+
+# webhook events after which SendGrid drops emails to the address
+SUPPRESSING_EVENTS = ("bounce", "spamreport")
+
+# reasons of 'dropped' event that are about the address rather than the email
+SUPPRESSING_DROP_REASONS = ("Bounced Address",
+                            "Unsubscribed Address",
+                            "Spam Reporting Address",
+                            "Invalid")
+
+# number of emails sent to Redis in one command
+CHUNK_SIZE = 1000
+
+
+def add(emails, key=SUPPRESSED_KEY):
+    """
+    Add emails to the set of addresses SendGrid won't deliver to.
+
+    :param emails: iterable of email addresses
+    :param key: cache key of the set
+    """
+    cache = frappe.cache()
+    key = cache.make_key(key)
+    pipeline = cache.pipeline()
+    for chunk in chunked((email.strip().lower() for email in emails if email), CHUNK_SIZE):
+        pipeline.sadd(key, *chunk)
+    pipeline.execute()
+
+
+def add_from_events(events):
+    """
+    Add emails of bounce, spam report and address related drop events to the set.
+
+    :param events: list of SendGrid events received from webhook request
+    """
+    add(event.get("email") for event in events
+        if event.get("event") in SUPPRESSING_EVENTS or (
+            event.get("event") == "dropped" and
+            event.get("reason") in SUPPRESSING_DROP_REASONS))
+
+
+def get_suppressed(emails):
+    """
+    Get emails that are in the set, checking all of them takes one round trip.
+
+    :param emails: list of email addresses
+    """
+    if not emails:
+        return set()
+
+    cache = frappe.cache()
+    key = cache.make_key(SUPPRESSED_KEY)
+    pipeline = cache.pipeline()
+    for email in emails:
+        pipeline.sismember(key, email.strip().lower())
+
+    return set(email for email, suppressed in zip(emails, pipeline.execute())
+               if suppressed)
+
+
+def remove(emails):
+    """
+    Remove emails from the set, e.g. when they are allowed to receive emails again.
+
+    :param emails: iterable of email addresses
+    """
+    cache = frappe.cache()
+    key = cache.make_key(SUPPRESSED_KEY)
+    pipeline = cache.pipeline()
+    for chunk in chunked((email.strip().lower() for email in emails if email), CHUNK_SIZE):
+        pipeline.srem(key, *chunk)
+    pipeline.execute()
+
+
+def rebuild():
+    """
+    Replace the set with emails of global Email Unsubscribe records.
+
+    Blacklisted emails are globally unsubscribed when they are synced, so this restores
+    the set when Redis cache is flushed and drops emails that are not unsubscribed
+    anymore. The new set is filled under another key and renamed over the live one, so
+    it's never seen half filled. Run via Weekly Scheduler.
+    """
+    cache = frappe.cache()
+    rebuild_key = cache.make_key(REBUILD_KEY)
+    cache.delete(rebuild_key)
+
+    add(frappe.db.sql_list("""select email from `tabEmail Unsubscribe`
+        where global_unsubscribe=1"""), key=REBUILD_KEY)
+
+    if cache.exists(rebuild_key):
+        cache.rename(rebuild_key, cache.make_key(SUPPRESSED_KEY))
+    else:
+        cache.delete(cache.make_key(SUPPRESSED_KEY))
+
+
+def remove_unsubscribed(doc, method=None):
+    """
+    Remove email of deleted global Email Unsubscribe from the set, unless it's globally
+    unsubscribed by another record. Called via Email Unsubscribe on_trash hook.
+    """
+    if not doc.global_unsubscribe or not doc.email:
+        return
+
+    if not frappe.db.sql("""select name from `tabEmail Unsubscribe`
+            where global_unsubscribe=1 and email=%s and name!=%s limit 1""",
+                         (doc.email, doc.name)):
+        remove([doc.email])
+
+
+def skip_suppressed_recipients(doc, method=None):
+    """
+    Remove suppressed recipients from Email Queue before it is saved.
+
+    Enabled by `sendgrid_skip_suppressed` in site config. Email without recipients left
+    is not sent. Called via Email Queue before_insert hook.
+    """
+    if not frappe.conf.sendgrid_skip_suppressed:
+        return
+
+    recipients = doc.get("recipients") or []
+    suppressed = get_suppressed([recipient.recipient for recipient in recipients])
+    if not suppressed:
+        return
+
+    doc.set("recipients", [recipient for recipient in recipients
+                           if recipient.recipient not in suppressed])
+
+    if not doc.recipients:
+        doc.status = "Error"
+        doc.error = "All recipients are suppressed by SendGrid: {}".format(
+            ", ".join(sorted(suppressed)))
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, Semilimes
+# For license information, please see license.txt
+
+import time
+import pickle
+import fnmatch
+
+import redis
+from redis.exceptions import ResponseError
+
+
+def to_str(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return str(value)
+
+
+class StandInRedis(redis.Redis):
+    """
+    Dict-backed stand-in for frappe cache, no Redis server is needed.
+
+    Raw Redis methods run against dicts, list methods and `hgetall` are wrapped the way
+    `frappe.utils.redis_wrapper.RedisWrapper` wraps them: they prefix the key
+    themselves, and `rpush`/`lpush` take one value and return nothing.
+
+    :param prefix: key prefix, database name of the site
+    """
+
+    def __init__(self, prefix="test_site"):
+        self.prefix = prefix
+        self.data = dict()
+        self.expires = dict()
+        self.connection = None
+        self.connection_pool = None
+
+    # RedisWrapper methods
+
+    def make_key(self, key, user=None):
+        return "{}|{}".format(self.prefix, key)
+
+    def get_value(self, key, generator=None, user=None, expires=False):
+        value = redis.Redis.get(self, self.make_key(key))
+        if value is not None:
+            return pickle.loads(value.encode("latin-1"))
+        if generator:
+            value = generator()
+            self.set_value(key, value)
+        return value
+
+    def set_value(self, key, val, user=None, expires_in_sec=None):
+        redis.Redis.set(self, self.make_key(key),
+                        pickle.dumps(val, 0).decode("latin-1"), ex=expires_in_sec)
+
+    def delete_value(self, keys, user=None, make_keys=True):
+        if not isinstance(keys, (list, tuple)):
+            keys = (keys,)
+        redis.Redis.delete(self, *[self.make_key(key) for key in keys])
+
+    def lpush(self, key, value):
+        redis.Redis.lpush(self, self.make_key(key), value)
+
+    def rpush(self, key, value):
+        redis.Redis.rpush(self, self.make_key(key), value)
+
+    def lpop(self, key):
+        return redis.Redis.lpop(self, self.make_key(key))
+
+    def llen(self, key):
+        return redis.Redis.llen(self, self.make_key(key))
+
+    def lrange(self, key, start, stop):
+        return redis.Redis.lrange(self, self.make_key(key), start, stop)
+
+    def hgetall(self, name):
+        return dict((key, pickle.loads(value.encode("latin-1"))) for key, value in
+                    redis.Redis.hgetall(self, self.make_key(name)).items())
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return StandInPipeline(self)
+
+    # Redis commands
+
+    def execute_command(self, *args, **options):
+        command, args = args[0].upper(), args[1:]
+        method = getattr(self, "_" + command.lower(), None)
+        if not method:
+            raise NotImplementedError(command)
+        return method(*args)
+
+    def _get_item(self, key, default=None):
+        key = to_str(key)
+        if key in self.expires and self.expires[key] <= time.time():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        if key not in self.data and default is not None:
+            self.data[key] = default
+        return self.data.get(key)
+
+    def _get(self, key):
+        return self._get_item(key)
+
+    def _set(self, key, value, *options):
+        options = [to_str(option).upper() for option in options]
+        if "NX" in options and self._get_item(key) is not None:
+            return None
+        if "XX" in options and self._get_item(key) is None:
+            return None
+
+        key = to_str(key)
+        self.data[key] = to_str(value)
+        self.expires.pop(key, None)
+        if "EX" in options:
+            self.expires[key] = time.time() + int(options[options.index("EX") + 1])
+        return True
+
+    def _delete(self, *keys):
+        deleted = 0
+        for key in keys:
+            if self._get_item(key) is not None:
+                deleted += 1
+            self.data.pop(to_str(key), None)
+            self.expires.pop(to_str(key), None)
+        return deleted
+
+    _del = _delete
+
+    def _exists(self, *keys):
+        return sum(1 for key in keys if self._get_item(key) is not None)
+
+    def _expire(self, key, seconds):
+        if self._get_item(key) is None:
+            return 0
+        self.expires[to_str(key)] = time.time() + int(seconds)
+        return 1
+
+    def _ttl(self, key):
+        if self._get_item(key) is None:
+            return -2
+        if to_str(key) not in self.expires:
+            return -1
+        return int(round(self.expires[to_str(key)] - time.time()))
+
+    def _rename(self, src, dst):
+        if self._get_item(src) is None:
+            raise ResponseError("no such key")
+        self.data[to_str(dst)] = self.data.pop(to_str(src))
+        self.expires.pop(to_str(dst), None)
+        if to_str(src) in self.expires:
+            self.expires[to_str(dst)] = self.expires.pop(to_str(src))
+        return True
+
+    def _incrby(self, key, amount):
+        value = int(self._get_item(key) or 0) + int(amount)
+        self.data[to_str(key)] = str(value)
+        return value
+
+    def _keys(self, pattern="*"):
+        return [key for key in list(self.data) if self._get_item(key) is not None and
+                fnmatch.fnmatchcase(key, to_str(pattern))]
+
+    # lists
+
+    def _list(self, key):
+        return self._get_item(key, default=[])
+
+    def _cleanup(self, key):
+        if not self.data.get(to_str(key)):
+            self.data.pop(to_str(key), None)
+            self.expires.pop(to_str(key), None)
+
+    def _rpush(self, key, *values):
+        items = self._list(key)
+        items.extend(to_str(value) for value in values)
+        return len(items)
+
+    def _lpush(self, key, *values):
+        items = self._list(key)
+        for value in values:
+            items.insert(0, to_str(value))
+        return len(items)
+
+    def _lpop(self, key):
+        items = self._list(key)
+        item = items.pop(0) if items else None
+        self._cleanup(key)
+        return item
+
+    def _rpop(self, key):
+        items = self._list(key)
+        item = items.pop() if items else None
+        self._cleanup(key)
+        return item
+
+    def _rpoplpush(self, src, dst):
+        item = self._rpop(src)
+        if item is not None:
+            self._lpush(dst, item)
+        return item
+
+    def _lindex(self, key, index):
+        items = self._get_item(key) or []
+        try:
+            return items[int(index)]
+        except IndexError:
+            return None
+
+    def _llen(self, key):
+        return len(self._get_item(key) or [])
+
+    def _lrange(self, key, start, stop):
+        items = self._get_item(key) or []
+        stop = int(stop)
+        return items[int(start):None if stop == -1 else stop + 1]
+
+    def _lrem(self, key, count, value):
+        items = self._list(key)
+        count, value = int(count), to_str(value)
+        kept, removed = list(), 0
+        for item in (reversed(items) if count < 0 else items):
+            if item == value and (not count or removed < abs(count)):
+                removed += 1
+            else:
+                kept.append(item)
+        items[:] = reversed(kept) if count < 0 else kept
+        self._cleanup(key)
+        return removed
+
+    # sets
+
+    def _sadd(self, key, *values):
+        items = self._get_item(key, default=set())
+        before = len(items)
+        items.update(to_str(value) for value in values)
+        return len(items) - before
+
+    def _srem(self, key, *values):
+        items = self._get_item(key, default=set())
+        before = len(items)
+        items.difference_update(to_str(value) for value in values)
+        self._cleanup(key)
+        return before - len(items)
+
+    def _sismember(self, key, value):
+        return to_str(value) in (self._get_item(key) or set())
+
+    def _smembers(self, key):
+        return set(self._get_item(key) or set())
+
+    def _scard(self, key):
+        return len(self._get_item(key) or set())
+
+    # hashes
+
+    def _hash(self, key):
+        return self._get_item(key, default={})
+
+    def _hset(self, key, field, value):
+        items = self._hash(key)
+        new = to_str(field) not in items
+        items[to_str(field)] = to_str(value)
+        return int(new)
+
+    def _hget(self, key, field):
+        return (self._get_item(key) or {}).get(to_str(field))
+
+    def _hgetall(self, key):
+        return dict(self._get_item(key) or {})
+
+    def _hdel(self, key, *fields):
+        items = self._hash(key)
+        removed = sum(1 for field in fields if items.pop(to_str(field), None) is not None)
+        self._cleanup(key)
+        return removed
+
+    def _hincrby(self, key, field, amount=1):
+        items = self._hash(key)
+        value = int(items.get(to_str(field)) or 0) + int(amount)
+        items[to_str(field)] = str(value)
+        return value
+
+    def _hincrbyfloat(self, key, field, amount=1.0):
+        items = self._hash(key)
+        value = float(items.get(to_str(field)) or 0) + float(amount)
+        items[to_str(field)] = repr(value)
+        return value
+
+
+class StandInPipeline(object):
+    """Pipeline of `StandInRedis`, commands are run with raw keys on `execute`."""
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self.commands = list()
+
+    def __getattr__(self, name):
+        method = getattr(redis.Redis, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+
+        return queue
+
+    def execute(self):
+        commands, self.commands = self.commands, list()
+        return [method(self.redis, *args, **kwargs) for method, args, kwargs in commands]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.commands = list()
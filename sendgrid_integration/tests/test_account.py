@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, Semilimes
+# For license information, please see license.txt
+
+import base64
+import unittest
+
+import frappe
+
+from sendgrid_integration import account
+
+
+class TestWebhookAccount(unittest.TestCase):
+    def setUp(self):
+        self.get_webhook_credentials = account.get_webhook_credentials
+        # credentials are read from the database as unicode
+        account.get_webhook_credentials = lambda: [(u"user:pass", u"SendGrid Account"),
+                                                   (u"site:config", None)]
+        account._credentials_indexes.pop(frappe.local.site, None)
+
+    def tearDown(self):
+        account.get_webhook_credentials = self.get_webhook_credentials
+        account._credentials_indexes.pop(frappe.local.site, None)
+
+    def test_unicode_token(self):
+        # werkzeug returns header values as unicode
+        token = base64.b64encode(b"user:pass").decode("ascii")
+        self.assertEqual(account.get_webhook_account(token).email_account,
+                         "SendGrid Account")
+
+    def test_site_config_credentials(self):
+        token = base64.b64encode(b"site:config").decode("ascii")
+        self.assertIsNone(account.get_webhook_account(token).email_account)
+
+    def test_wrong_token(self):
+        token = base64.b64encode(b"user:wrong").decode("ascii")
+        self.assertIsNone(account.get_webhook_account(token))
+
+    def test_non_ascii_token(self):
+        self.assertIsNone(account.get_webhook_account(u"dXNlcjpw\xe4ss"))
+
+
+def get_communication(name, recipients, cc=None, delivery_status="Sent"):
+    return account.get_communication_entry(frappe._dict(
+        name=name, recipients=recipients, cc=cc, delivery_status=delivery_status))
+
+
+def get_event(event, email, message_id, timestamp):
+    return {"event": event, "email": email, "message_id": message_id,
+            "timestamp": timestamp}
+
+
+class TestCoalesceEvents(unittest.TestCase):
+    def setUp(self):
+        self.count_recipients = account.count_recipients
+        # statuses of SendGrid Recipient records, set by the batch
+        self.recipient_statuses = dict()
+        account.count_recipients = self.fake_count_recipients
+
+        self.communications = {
+            "<one@site>": get_communication("one", u"Müller <User@Bücher.de>"),
+            "<many@site>": get_communication("many", "a@x.com, b@x.com",
+                                             cc="c@x.com")}
+
+    def tearDown(self):
+        account.count_recipients = self.count_recipients
+
+    def fake_count_recipients(self, communications, delivery_statuses):
+        counts = dict()
+        for (communication, email), status in self.recipient_statuses.items():
+            if communication in communications and status in delivery_statuses:
+                counts[communication] = counts.get(communication, 0) + 1
+        return counts
+
+    def apply_recipient_events(self, events):
+        recipient_statuses = account.coalesce_recipient_events(events, self.communications)
+        self.recipient_statuses.update(recipient_statuses)
+        return account.get_failed_communications(recipient_statuses, self.communications)
+
+    def test_out_of_order_events(self):
+        events = [get_event("click", u"user@bücher.de", "<one@site>", 20),
+                  get_event("open", u"user@bücher.de", "<one@site>", 30),
+                  get_event("delivered", u"user@bücher.de", "<one@site>", 40)]
+        self.assertEqual(account.coalesce_events(events, self.communications),
+                         {"one": "Clicked"})
+
+    def test_equal_rank_by_timestamp(self):
+        events = [get_event("bounce", u"user@bücher.de", "<one@site>", 20),
+                  get_event("dropped", u"user@bücher.de", "<one@site>", 10)]
+        self.assertEqual(account.coalesce_events(events, self.communications),
+                         {"one": "Bounced"})
+        self.assertEqual(account.coalesce_events(events[::-1], self.communications),
+                         {"one": "Bounced"})
+
+        events[1]["timestamp"] = 30
+        self.assertEqual(account.coalesce_events(events, self.communications),
+                         {"one": "Rejected"})
+
+    def test_lower_rank_than_current_status(self):
+        self.communications["<one@site>"].delivery_status = "Clicked"
+        events = [get_event("open", u"user@bücher.de", "<one@site>", 20)]
+        self.assertEqual(account.coalesce_events(events, self.communications), {})
+
+    def test_one_bounce_of_many_recipients(self):
+        events = [get_event("delivered", "a@x.com", "<many@site>", 10),
+                  get_event("bounce", "b@x.com", "<many@site>", 20),
+                  get_event("open", "c@x.com", "<many@site>", 30)]
+
+        self.assertEqual(account.coalesce_events(events, self.communications),
+                         {"many": "Opened"})
+        self.assertEqual(self.apply_recipient_events(events), {})
+        self.assertEqual(self.recipient_statuses, {("many", "a@x.com"): "Sent",
+                                                   ("many", "b@x.com"): "Bounced",
+                                                   ("many", "c@x.com"): "Opened"})
+
+    def test_all_recipients_bounced(self):
+        self.apply_recipient_events([get_event("bounce", "a@x.com", "<many@site>", 10)])
+
+        events = [get_event("bounce", "B@X.com", "<many@site>", 20),
+                  get_event("spamreport", "c@x.com", "<many@site>", 30),
+                  get_event("delivered", "c@x.com", "<many@site>", 5)]
+        self.assertEqual(account.coalesce_events(events, self.communications), {})
+        self.assertEqual(self.apply_recipient_events(events),
+                         {"many": "Marked As Spam"})
+
+    def test_recipient_matching(self):
+        events = [get_event("open", u"USER@BÜCHER.DE", "<one@site>", 10),
+                  get_event("click", "user@xn--bcher-kva.de", "<one@site>", 20),
+                  get_event("bounce", u"other@bücher.de", "<one@site>", 30),
+                  get_event("bounce", "d@x.com", "<many@site>", 30),
+                  get_event("bounce", "a@x.com", "<other@site>", 30)]
+        self.assertEqual(account.coalesce_events(events, self.communications),
+                         {"one": "Clicked"})
+        self.assertEqual(account.coalesce_recipient_events(events, self.communications),
+                         {})
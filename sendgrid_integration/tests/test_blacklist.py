@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, Semilimes
+# For license information, please see license.txt
+
+import unittest
+
+import frappe
+
+from sendgrid_integration import blacklist, metrics
+
+
+class TestUnsubscribeBlacklisted(unittest.TestCase):
+    def setUp(self):
+        self.get_all = getattr(frappe, "get_all", None)
+        self.unsubscribe_emails = blacklist.unsubscribe_emails
+        self.report_timings = blacklist.report_timings
+        self.flush = metrics.flush
+        self.synced = list()
+        self.reported = list()
+
+        frappe.get_all = lambda doctype, filters=None, fields=None: [
+            frappe._dict(name=name, api_key=api_key, sendgrid_webhook_credentials="a:b")
+            for name, api_key in (("Sales", "key1"), ("Support", "key1"),
+                                  ("News", "key2"))]
+        blacklist.unsubscribe_emails = lambda api_key, **kwargs: self.synced.append(
+            (api_key, kwargs["endpoint"]))
+        blacklist.report_timings = lambda timings: self.reported.extend(
+            sorted(set(account for account, started, finished in timings)))
+        metrics.flush = lambda: None
+        frappe.conf.sendgrid_sync_threads = 1
+
+    def tearDown(self):
+        frappe.get_all = self.get_all
+        blacklist.unsubscribe_emails = self.unsubscribe_emails
+        blacklist.report_timings = self.report_timings
+        metrics.flush = self.flush
+        frappe.conf.pop("sendgrid_sync_threads", None)
+
+    def test_lists_are_processed_once_per_api_key(self):
+        blacklist.unsubscribe_blacklisted()
+
+        endpoints = [suppression_list["endpoint"]
+                     for suppression_list in blacklist.SUPPRESSION_LISTS]
+        self.assertEqual(sorted(self.synced),
+                         sorted([("key1", endpoint) for endpoint in endpoints] +
+                                [("key2", endpoint) for endpoint in endpoints]))
+        self.assertEqual(self.reported, ["News", "Sales, Support"])
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, Semilimes
+# For license information, please see license.txt
+
+import unittest
+
+import frappe
+
+from sendgrid_integration import dedup, webhook_events
+from sendgrid_integration.tests.stand_in_redis import StandInRedis
+
+
+def get_event(i):
+    return {"event": "open", "email": "{}@x.com".format(i), "message_id": str(i),
+            "timestamp": 1000 + i, "sg_event_id": "event{}".format(i)}
+
+
+class TestDropDuplicates(unittest.TestCase):
+    def setUp(self):
+        self.cache = frappe.cache
+        self.set_statuses = webhook_events.set_statuses
+        self.redis = StandInRedis()
+        frappe.cache = lambda: self.redis
+        self.applied = list()
+
+    def tearDown(self):
+        frappe.cache = self.cache
+        webhook_events.set_statuses = self.set_statuses
+
+    def get_ids(self, events):
+        return [event["sg_event_id"] for event in events]
+
+    def test_ids_are_remembered_after_commit(self):
+        events = [get_event(i) for i in range(3)] + [get_event(1)]
+        self.assertEqual(self.get_ids(dedup.drop_duplicates(events)),
+                         ["event0", "event1", "event2"])
+
+        # nothing was committed, retry is applied
+        self.assertEqual(len(dedup.drop_duplicates(events)), 3)
+
+        dedup.remember(events[:2])
+        self.assertEqual(self.get_ids(dedup.drop_duplicates(events)), ["event2"])
+
+    def test_events_of_failed_batch_are_retried(self):
+        def set_statuses(events, batch_size, email_account=None, after_commit=None):
+            for i in range(0, len(events), batch_size):
+                batch = events[i:i + batch_size]
+                if self.applied:
+                    raise SystemExit("worker timeout")
+                self.applied.extend(batch)
+                after_commit(batch)
+
+        webhook_events.set_statuses = set_statuses
+        frappe.conf.sendgrid_webhook_batch_size = 2
+        events = [get_event(i) for i in range(4)]
+        try:
+            with self.assertRaises(SystemExit):
+                webhook_events.process_events(events)
+        finally:
+            frappe.conf.pop("sendgrid_webhook_batch_size", None)
+
+        # only the committed batch is dropped when SendGrid retries the request
+        self.assertEqual(self.get_ids(dedup.drop_duplicates(events)),
+                         ["event2", "event3"])
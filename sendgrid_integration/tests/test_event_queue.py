@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, Semilimes
+# For license information, please see license.txt
+
+import json
+import time
+import unittest
+
+import frappe
+
+from sendgrid_integration import event_queue, metrics, webhook_events
+from sendgrid_integration.tests.stand_in_redis import StandInRedis
+
+
+class EventQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = frappe.cache
+        self.only_for = frappe.only_for
+        self.redis = StandInRedis()
+        frappe.cache = lambda: self.redis
+        frappe.only_for = lambda roles: None
+
+    def tearDown(self):
+        frappe.cache = self.cache
+        frappe.only_for = self.only_for
+
+    def get_list(self, key):
+        return self.redis.execute_command("LRANGE", self.redis.make_key(key), 0, -1)
+
+
+class TestEventQueue(EventQueueTestCase):
+    def test_push_returns_length(self):
+        self.assertEqual(event_queue.push("[]", "Account 1"), 1)
+        self.assertEqual(event_queue.push("[]"), 2)
+        self.assertEqual(len(self.get_list(event_queue.QUEUE_KEY)), 2)
+
+    def test_pop_and_ack(self):
+        event_queue.push('[{"event": "open"}]', "Account|1")
+        event_queue.push('[{"event": "click"}]')
+
+        item = event_queue.pop()
+        received_at, email_account, data = event_queue.parse(item)
+        self.assertAlmostEqual(received_at, time.time(), delta=5)
+        self.assertEqual(email_account, "Account|1")
+        self.assertEqual(data, '[{"event": "open"}]')
+        self.assertEqual(self.get_list(event_queue.PROCESSING_KEY), [item])
+
+        event_queue.ack(item)
+        self.assertEqual(self.get_list(event_queue.PROCESSING_KEY), [])
+
+        item = event_queue.pop()
+        self.assertEqual(event_queue.parse(item)[1:], (None, '[{"event": "click"}]'))
+        self.assertIsNone(event_queue.pop())
+
+    def test_requeue_unacknowledged(self):
+        for data in ("1", "2", "3"):
+            event_queue.push(data)
+        first, second = event_queue.pop(), event_queue.pop()
+        event_queue.ack(first)
+
+        event_queue.requeue_unacknowledged()
+        self.assertEqual(self.get_list(event_queue.PROCESSING_KEY), [])
+        self.assertEqual([event_queue.parse(item)[2] for item in
+                          self.get_list(event_queue.QUEUE_KEY)], ["2", "3"])
+        self.assertEqual(event_queue.parse(event_queue.pop())[2], "3")
+        self.assertEqual(event_queue.pop(), second)
+
+    def test_stats(self):
+        self.assertEqual(event_queue.get_stats(), {"depth": 0, "processing": 0,
+                                                   "oldest_age": 0, "last_lag": 0,
+                                                   "dead_letters": 0})
+
+        event_queue.push("1")
+        event_queue.push("2")
+        received_at = event_queue.parse(event_queue.pop())[0]
+        event_queue.set_lag(received_at - 3)
+
+        stats = event_queue.get_stats()
+        self.assertEqual(stats["depth"], 1)
+        self.assertEqual(stats["processing"], 1)
+        self.assertTrue(0 <= stats["oldest_age"] < 5)
+        self.assertTrue(3 <= stats["last_lag"] < 8)
+
+    def test_lock(self):
+        lock = event_queue.acquire_lock()
+        self.assertTrue(lock)
+        self.assertIsNone(event_queue.acquire_lock())
+        self.assertTrue(event_queue.renew_lock(lock))
+
+        event_queue.release_lock(lock)
+        self.assertIsNone(self.redis.get(self.redis.make_key(event_queue.LOCK_KEY)))
+
+    def test_expired_lock_is_not_released(self):
+        lock = event_queue.acquire_lock()
+        # lock expires and another worker takes it over
+        self.redis.delete(self.redis.make_key(event_queue.LOCK_KEY))
+        other_lock = event_queue.acquire_lock()
+
+        self.assertFalse(event_queue.renew_lock(lock))
+        event_queue.release_lock(lock)
+        self.assertTrue(event_queue.renew_lock(other_lock))
+
+
+class RollbackDB(object):
+    def __init__(self):
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class TestDrainEventQueue(EventQueueTestCase):
+    def setUp(self):
+        super(TestDrainEventQueue, self).setUp()
+        self.process_events = webhook_events.process_events
+        self.flush = metrics.flush
+        self.db = getattr(frappe, "db", None)
+        self.processed = list()
+        webhook_events.process_events = self.fake_process_events
+        metrics.flush = lambda: None
+        frappe.db = RollbackDB()
+
+    def tearDown(self):
+        webhook_events.process_events = self.process_events
+        metrics.flush = self.flush
+        frappe.db = self.db
+        super(TestDrainEventQueue, self).tearDown()
+
+    def fake_process_events(self, events, email_account=None):
+        if any(event.get("event") == "poison" for event in events):
+            raise ValueError("poison event")
+        self.processed.append((email_account, events))
+
+    def test_drain(self):
+        event_queue.push(json.dumps([{"event": "open"}]), "Account 1")
+        event_queue.push(json.dumps([{"event": "click"}]))
+        # left behind by a crashed worker
+        event_queue.pop()
+
+        webhook_events.drain_event_queue()
+
+        self.assertEqual(sorted(self.processed), [
+            (None, [{"event": "click"}]), ("Account 1", [{"event": "open"}])])
+        # queue, processing list and lock are gone, only the lag is left
+        self.assertEqual(list(self.redis.data), [self.redis.make_key(event_queue.LAG_KEY)])
+
+    def test_drain_stops_when_lock_is_lost(self):
+        event_queue.push(json.dumps([{"event": "open"}]))
+        other_lock = list()
+
+        def take_over_lock(events, email_account=None):
+            self.fake_process_events(events, email_account)
+            event_queue.push(json.dumps([{"event": "click"}]))
+            self.redis.delete(self.redis.make_key(event_queue.LOCK_KEY))
+            other_lock.append(event_queue.acquire_lock())
+
+        webhook_events.process_events = take_over_lock
+        webhook_events.drain_event_queue()
+
+        # the second request is left to the worker holding the lock now
+        self.assertEqual(self.processed, [(None, [{"event": "open"}])])
+        self.assertEqual(len(self.get_list(event_queue.QUEUE_KEY)), 1)
+        self.assertEqual(self.get_list(event_queue.PROCESSING_KEY), [])
+        self.assertTrue(event_queue.renew_lock(other_lock[0]))
+
+    def test_failing_item_is_moved_to_dead_letters(self):
+        event_queue.push(json.dumps([{"event": "open"}]))
+        event_queue.push(json.dumps([{"event": "poison"}]))
+        event_queue.push("not json")
+        event_queue.push(json.dumps([{"event": "click"}]))
+
+        webhook_events.drain_event_queue()
+
+        # requests of the failed batch are applied one by one
+        self.assertEqual(self.processed, [(None, [{"event": "open"}]),
+                                          (None, [{"event": "click"}])])
+        self.assertEqual(len(self.get_list(event_queue.PROCESSING_KEY)), 2)
+
+        for i in range(event_queue.MAX_ATTEMPTS):
+            webhook_events.drain_event_queue()
+
+        stats = event_queue.get_stats()
+        self.assertEqual((stats["depth"], stats["processing"], stats["dead_letters"]),
+                         (0, 0, 2))
+        self.assertEqual(sorted(event_queue.parse(item)[2] for item in
+                                self.get_list(event_queue.DEAD_LETTER_KEY)),
+                         ['[{"event": "poison"}]', "not json"])
+        self.assertEqual(len(self.processed), 2)
+        self.assertEqual(self.redis.hgetall(event_queue.ATTEMPTS_KEY), {})
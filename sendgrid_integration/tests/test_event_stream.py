@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, Semilimes
+# For license information, please see license.txt
+
+import io
+import json
+import unittest
+
+from sendgrid_integration.event_stream import EventReader
+
+
+def get_event(i):
+    return {"event": "open", "email": "{}@x.com".format(i), "message_id": str(i),
+            "timestamp": 1000 + i, "sg_event_id": "event{}".format(i)}
+
+
+class TestEventReader(unittest.TestCase):
+    def read(self, body, **kwargs):
+        reader = EventReader(io.BytesIO(body), **kwargs)
+        return [event["message_id"] for event in reader], reader.skipped
+
+    def test_events(self):
+        body = json.dumps([get_event(i) for i in range(100)]).encode("utf-8")
+        self.assertEqual(self.read(body, read_size=7),
+                         ([str(i) for i in range(100)], 0))
+
+    def test_malformed_event_is_counted_once(self):
+        body = ('[%s, %s, {"event": "open", "x": {"a": {"b": 1}, "c": {"d": 2}}, bad}, '
+                '%s, {"event": "open", "x": {"a": 1}, "y": [}, "z": {"b": 2}}, '
+                '{"event": "open"}]') % tuple(json.dumps(get_event(i)) for i in range(3))
+        for read_size in (5, 64 * 1024):
+            self.assertEqual(self.read(body.encode("utf-8"), read_size=read_size),
+                             (["0", "1", "2", None], 2))
+
+    def test_invalid_event_is_counted(self):
+        body = '[{"email": "a@x.com"}, 1, %s]' % json.dumps(get_event(0))
+        self.assertEqual(self.read(body.encode("utf-8")), (["0"], 2))
+
+    def test_fallback_for_consumed_stream(self):
+        body = json.dumps([get_event(0), get_event(1)]).encode("utf-8")
+        self.assertEqual(self.read(b"", fallback=lambda: body), (["0", "1"], 0))
+
+    def test_not_array(self):
+        with self.assertRaises(ValueError):
+            self.read(b"", fallback=lambda: b"")
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, Semilimes
+# For license information, please see license.txt
+
+import quopri
+import smtplib
+import unittest
+from email.mime.text import MIMEText
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+
+import frappe
+
+from sendgrid_integration import mail_send
+from sendgrid_integration.benchmarks.stub import StubSendGrid, StubSMTP
+
+
+def prepare_message(email, recipient, recipients_list):
+    """Replace recipient placeholders the way Frappe does."""
+    unsubscribe_url = "https://example.com/unsubscribe?email={}".format(recipient)
+    return (email.message.replace("<!--unsubscribe url-->",
+                                  quopri.encodestring(unsubscribe_url))
+            .replace("<!--recipient-->", recipient))
+
+
+class SMTPServer(object):
+    """SMTP server of Email Account connecting to local SMTP sink."""
+    address = None
+    sessions = list()
+
+    def setup_email_account(self, append_to=None, sender=None):
+        pass
+
+    @property
+    def sess(self):
+        if not hasattr(self, "_sess"):
+            self._sess = smtplib.SMTP(*self.address)
+            self.sessions.append(self._sess)
+        return self._sess
+
+
+class TestSendEmail(unittest.TestCase):
+    sender = "Sender <sender@example.com>"
+
+    def setUp(self):
+        self.get_recipients = mail_send.get_recipients
+        self.set_sent = mail_send.set_sent
+        self.prepare_message = mail_send.prepare_message
+        self.smtp_server = mail_send.SMTPServer
+        self.api_url = frappe.conf.sendgrid_api_url
+
+        self.stub = StubSendGrid().start()
+        frappe.conf.sendgrid_api_url = self.stub.url
+        self.recipients = [frappe._dict(name=str(i), recipient=recipient, status=status)
+                           for i, (recipient, status) in enumerate((
+                               ("sent@example.com", "Sent"),
+                               ("to@example.com", "Not Sent"),
+                               ("cc@example.com", "Not Sent"),
+                               ("other@example.com", "Not Sent")))]
+        mail_send.get_recipients = lambda email_name: self.recipients
+        mail_send.set_sent = self.fake_set_sent
+        mail_send.prepare_message = prepare_message
+        frappe.local.sendgrid_web_api_accounts = {
+            "sender@example.com": frappe._dict(name="SendGrid", api_key="mail-send-key",
+                                               service="SendGrid")}
+
+    def tearDown(self):
+        self.stub.stop()
+        mail_send.get_recipients = self.get_recipients
+        mail_send.set_sent = self.set_sent
+        mail_send.prepare_message = self.prepare_message
+        mail_send.SMTPServer = self.smtp_server
+        frappe.conf.sendgrid_api_url = self.api_url
+        del frappe.local.sendgrid_web_api_accounts
+        for name in ("sendgrid_sent_recipients", "sendgrid_smtp_session"):
+            if hasattr(frappe.local, name):
+                delattr(frappe.local, name)
+
+    def fake_set_sent(self, email_name, recipients):
+        emails = [email for recipient in recipients
+                  for email in recipient["to"] + recipient.get("cc", [])]
+        for recipient in self.recipients:
+            if recipient.recipient in emails:
+                recipient.status = "Sent"
+
+    def get_email(self, cc=None):
+        message = MIMEMultipart("related")
+        message["From"] = self.sender
+        message["To"] = "<!--recipient-->"
+        message["Subject"] = "Test"
+        message["Message-Id"] = "<abc@example.com>"
+        message["In-Reply-To"] = "<parent@example.com>"
+        message["List-Unsubscribe"] = "<<!--unsubscribe url-->>"
+        if cc:
+            message["To"] = "to@example.com, other@example.com"
+            message["Cc"] = cc
+        message.attach(MIMEText(u'Hello <img src="cid:logo"> <!--unsubscribe url-->',
+                                "html", "utf-8"))
+        image = MIMEImage(b"GIF89a", "gif")
+        image["Content-ID"] = "<logo>"
+        message.attach(image)
+        return frappe._dict(name="Email 1", message=message.as_string(),
+                            reference_doctype=None)
+
+    def flush(self, email):
+        """Send recipients of Email Queue one by one the way Frappe does."""
+        for recipient in [recipient for recipient in self.recipients
+                          if recipient.status == "Not Sent"]:
+            mail_send.send_email(email, self.sender, recipient.recipient,
+                                 prepare_message(email, recipient.recipient,
+                                                 self.recipients))
+            recipient.status = "Sent"
+
+    def test_web_api_sends_email_queue_in_one_request(self):
+        self.flush(self.get_email())
+
+        data, = self.stub.mails
+        self.assertEqual([personalization["to"]
+                          for personalization in data["personalizations"]],
+                         [[{"email": "to@example.com"}], [{"email": "cc@example.com"}],
+                          [{"email": "other@example.com"}]])
+        personalization = data["personalizations"][0]
+        unsubscribe_url = "https://example.com/unsubscribe?email=to@example.com"
+        self.assertEqual(personalization["custom_args"],
+                         {"message_id": "<abc@example.com>"})
+        self.assertEqual(personalization["substitutions"],
+                         {"<!--unsubscribe url-->": unsubscribe_url,
+                          "<!--recipient-->": "to@example.com"})
+        self.assertEqual(personalization["headers"],
+                         {"List-Unsubscribe": "<{}>".format(unsubscribe_url)})
+
+        self.assertEqual(data["from"], {"email": "sender@example.com", "name": "Sender"})
+        self.assertEqual(data["headers"]["In-Reply-To"], "<parent@example.com>")
+        self.assertEqual(data["content"], [{
+            "type": "text/html",
+            "value": u'Hello <img src="cid:logo"> <!--unsubscribe url-->'}])
+        attachment, = data["attachments"]
+        self.assertEqual((attachment["content_id"], attachment["disposition"],
+                          attachment["type"]), ("logo", "inline", "image/gif"))
+        self.assertEqual(frappe.local.sendgrid_sent_recipients, {})
+
+    def test_cc_recipients_get_one_copy(self):
+        self.flush(self.get_email(cc="Copy <CC@example.com>"))
+
+        data, = self.stub.mails
+        personalization, = data["personalizations"]
+        self.assertEqual(personalization["to"], [{"email": "to@example.com"},
+                                                 {"email": "other@example.com"}])
+        self.assertEqual(personalization["cc"], [{"email": "cc@example.com"}])
+
+    def test_failed_request_is_retried(self):
+        mail_send.MAX_PERSONALIZATIONS, max_personalizations = (
+            2, mail_send.MAX_PERSONALIZATIONS)
+        self.stub.accepted_mails = 1
+        try:
+            with self.assertRaises(smtplib.SMTPServerDisconnected):
+                self.flush(self.get_email())
+        finally:
+            mail_send.MAX_PERSONALIZATIONS = max_personalizations
+
+        # recipients of the failed request are sent by the next flush
+        self.assertEqual([recipient.status for recipient in self.recipients],
+                         ["Sent", "Sent", "Sent", "Not Sent"])
+        self.stub.accepted_mails = None
+        self.flush(self.get_email())
+        self.assertEqual([[to["email"] for personalization in data["personalizations"]
+                           for to in personalization["to"]]
+                          for data in self.stub.mails],
+                         [["to@example.com", "cc@example.com"], ["other@example.com"]])
+
+    def test_other_sender_uses_smtp(self):
+        stub_smtp = StubSMTP().start()
+        SMTPServer.address, SMTPServer.sessions = stub_smtp.address, list()
+        mail_send.SMTPServer = SMTPServer
+        frappe.local.sendgrid_web_api_accounts = dict()
+        try:
+            self.flush(self.get_email())
+        finally:
+            stub_smtp.stop()
+
+        self.assertEqual(self.stub.mails, [])
+        self.assertEqual((stub_smtp.messages, stub_smtp.recipients), (3, 3))
+        # one session is opened for the Email Queue and quit after its last recipient
+        session, = SMTPServer.sessions
+        self.assertIsNone(session.sock)
+        self.assertFalse(hasattr(frappe.local, "sendgrid_smtp_session"))
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, Semilimes
+# For license information, please see license.txt
+
+import unittest
+
+import frappe
+
+from sendgrid_integration import suppression
+from sendgrid_integration.tests.stand_in_redis import StandInRedis
+
+
+class UnsubscribeDB(object):
+    """Emails of global Email Unsubscribe records kept in memory."""
+
+    def __init__(self, unsubscribes):
+        self.unsubscribes = unsubscribes
+
+    def sql_list(self, query, values=None):
+        return [email for name, email in self.unsubscribes]
+
+    def sql(self, query, values=None):
+        email, name = values
+        return [(other_name,) for other_name, other_email in self.unsubscribes
+                if other_email == email and other_name != name]
+
+
+class TestSuppression(unittest.TestCase):
+    def setUp(self):
+        self.cache = frappe.cache
+        self.db = getattr(frappe, "db", None)
+        self.redis = StandInRedis()
+        frappe.cache = lambda: self.redis
+
+    def tearDown(self):
+        frappe.cache = self.cache
+        frappe.db = self.db
+
+    def test_rebuild_replaces_set(self):
+        suppression.add(["Old@x.com", "kept@x.com"])
+        frappe.db = UnsubscribeDB([("1", "kept@x.com"), ("2", "New@x.com")])
+
+        suppression.rebuild()
+        self.assertEqual(suppression.get_suppressed(["old@x.com", "kept@x.com",
+                                                     "new@x.com"]),
+                         set(["kept@x.com", "new@x.com"]))
+        self.assertEqual(list(self.redis.data),
+                         [self.redis.make_key(suppression.SUPPRESSED_KEY)])
+
+        frappe.db = UnsubscribeDB([])
+        suppression.rebuild()
+        self.assertEqual(self.redis.data, {})
+
+    def test_deleted_unsubscribe_is_removed(self):
+        suppression.add(["a@x.com", "b@x.com"])
+        frappe.db = UnsubscribeDB([("2", "b@x.com"), ("3", "b@x.com")])
+
+        for name, email in (("1", "a@x.com"), ("2", "b@x.com")):
+            suppression.remove_unsubscribed(frappe._dict(name=name, email=email,
+                                                         global_unsubscribe=1))
+
+        # b@x.com is still unsubscribed by another record
+        self.assertEqual(suppression.get_suppressed(["a@x.com", "b@x.com"]),
+                         set(["b@x.com"]))
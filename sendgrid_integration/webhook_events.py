@@ -3,11 +3,17 @@
 # MIT License. See license.txt
 
 import json
-import base64
+from collections import defaultdict
 
 import frappe
 
-from .account import set_status, get_webhook_credentials
+from . import dedup, event_queue, metrics, router, suppression
+from .account import (set_status, set_statuses, get_webhook_account, chunked,
+                      WEBHOOK_BATCH_SIZE)
+from .event_stream import EventReader, compact_event
+from .smtpapi import get_header
+from .sendgrid_integration.doctype.sendgrid_engagement.sendgrid_engagement import (
+    count_events)
 
 
 @frappe.whitelist(allow_guest=True, xss_safe=True)
@@ -46,26 +52,207 @@ def notify(sendgrid_events=None):
     ]
 
     + every event will have additional argument 'message_id' with local message ID
+
+    Events are applied in batches of `sendgrid_webhook_batch_size` (site config) events
+    per transaction, setting it to 0 applies and commits events one by one.
+
+    When `sendgrid_webhook_queue` is set in site config, request body is only validated
+    and queued, events are applied later by background job `drain_event_queue`.
+
+    When `sendgrid_webhook_streaming` is set in site config, events are decoded from
+    request stream one by one and applied batch by batch, so memory used doesn't grow with
+    request size.
     """
     if not frappe.request:
         return
 
-    if not authenticate_credentials():
+    metrics.incr("sendgrid_webhook_requests_total")
+    with metrics.stage("auth"):
+        webhook_account = authenticate_credentials()
+    if not webhook_account:
+        metrics.incr("sendgrid_webhook_auth_failures_total")
         raise frappe.AuthenticationError
 
+    if frappe.conf.sendgrid_webhook_streaming and not frappe.conf.sendgrid_webhook_queue:
+        # body read already by the time the hook runs is taken from memory
+        process_event_stream(frappe.request.stream, webhook_account.email_account,
+                             fallback=frappe.request.get_data)
+        return
+
     try:
-        sendgrid_events = json.loads(frappe.request.data) or []
-        for event in sendgrid_events:
-            set_status(event.get("event"), event.get("email"), event.get("message_id"))
+        with metrics.stage("parse"):
+            sendgrid_events = json.loads(frappe.request.data) or []
+    except ValueError:
+        frappe.errprint("Bad SendGrid webhook request")
+        return
+
+    if frappe.conf.sendgrid_webhook_queue:
+        # first request of a new backlog starts the worker, scheduler picks up the rest
+        if event_queue.push(frappe.request.data,
+                            webhook_account.email_account) == 1:
+            frappe.enqueue("sendgrid_integration.webhook_events.drain_event_queue")
+        return
+
+    process_events(sendgrid_events, webhook_account.email_account)
+
+
+def process_event_stream(stream, email_account=None, fallback=None):
+    """
+    Decode SendGrid events from stream and apply them batch by batch.
+
+    :param stream: file-like object with webhook request body
+    :param email_account: Email Account the webhook request was authenticated for, None
+                          for credentials from site config
+    :param fallback: function returning the whole body when the stream was read already
+    """
+    reader = EventReader(stream, fallback=fallback)
+    batch_size = frappe.conf.sendgrid_webhook_batch_size or WEBHOOK_BATCH_SIZE
+
+    try:
+        for sendgrid_events in chunked(reader, batch_size):
+            process_events(sendgrid_events, email_account)
     except ValueError:
         frappe.errprint("Bad SendGrid webhook request")
 
+    if reader.skipped:
+        frappe.errprint("Skipped {} bad events in SendGrid webhook request".format(
+            reader.skipped))
+
+
+def process_events(sendgrid_events, email_account=None):
+    """
+    Apply SendGrid events to communications.
+
+    :param sendgrid_events: list of SendGrid events received from webhook request
+    :param email_account: Email Account the webhook request was authenticated for, None
+                          for credentials from site config
+    """
+    # bad events are skipped one by one
+    sendgrid_events = [event for event in map(compact_event, sendgrid_events) if event]
+
+    # one webhook can serve all sites of the bench, other sites apply their events
+    if frappe.conf.sendgrid_webhook_router:
+        sendgrid_events = router.route_events(sendgrid_events)
+
+    # SendGrid retries whole requests, events applied already are dropped; ids are
+    # remembered batch by batch after commit, so retry applies events that failed
+    remember = None
+    if frappe.conf.get("sendgrid_webhook_dedup", 1):
+        sendgrid_events = dedup.drop_duplicates(sendgrid_events)
+        remember = dedup.remember
+
+    batch_size = frappe.conf.get("sendgrid_webhook_batch_size", WEBHOOK_BATCH_SIZE)
+    if batch_size:
+        set_statuses(sendgrid_events, batch_size=batch_size,
+                     email_account=email_account, after_commit=remember)
+    else:
+        for event in sendgrid_events:
+            set_status(event.get("event"), event.get("email"),
+                       event.get("message_id"),
+                       timestamp=event.get("timestamp"),
+                       sg_event_id=event.get("sg_event_id"),
+                       email_account=email_account)
+            if remember:
+                remember([event])
+
+    metrics.incr("sendgrid_webhook_events_total", len(sendgrid_events))
+
+    if frappe.conf.sendgrid_engagement_counters:
+        count_events(sendgrid_events, email_account)
+
+    suppression.add_from_events(sendgrid_events)
+
+
+def drain_event_queue():
+    """
+    Apply webhook requests queued by `notify` until the queue is empty.
+
+    Requests are popped and applied in batches of about `sendgrid_webhook_batch_size`
+    events. When a batch fails, its requests are applied one by one, so only the failing
+    ones stay unacknowledged; they are retried by the next run and moved to the dead
+    letter list after `event_queue.MAX_ATTEMPTS` attempts. Run via background job
+    started by `notify` and via All Scheduler.
+    """
+    lock = event_queue.acquire_lock()
+    if not lock:
+        return
+
+    try:
+        event_queue.requeue_unacknowledged()
+
+        batch_size = frappe.conf.get("sendgrid_webhook_batch_size") or WEBHOOK_BATCH_SIZE
+        while True:
+            # worker that lost the lock leaves the queue to the one holding it now
+            if not event_queue.renew_lock(lock):
+                frappe.errprint("SendGrid event queue lock expired, draining stopped")
+                break
+
+            popped = False
+            batch = list()
+            events_count = 0
+            while events_count < batch_size:
+                item = event_queue.pop()
+                if not item:
+                    break
+
+                popped = True
+                try:
+                    received_at, email_account, data = event_queue.parse(item)
+                    events = json.loads(data) or []
+                except ValueError:
+                    # stays unacknowledged until it's moved to dead letters
+                    frappe.errprint("Bad SendGrid event queue item")
+                    continue
+
+                batch.append((item, email_account, events))
+                events_count += len(events)
+
+            if not popped:
+                break
+
+            try:
+                apply_queued_events(batch)
+            except Exception:
+                frappe.db.rollback()
+                for queued in batch:
+                    try:
+                        apply_queued_events([queued])
+                    except Exception:
+                        frappe.db.rollback()
+                        frappe.errprint(frappe.get_traceback())
+
+            if batch:
+                event_queue.set_lag(received_at)
+    finally:
+        event_queue.release_lock(lock)
+        metrics.flush()
+
+
+def apply_queued_events(batch):
+    """
+    Apply events of queued webhook requests and acknowledge the requests.
+
+    :param batch: list of queue item, Email Account and events of the request
+    """
+    sendgrid_events = defaultdict(list)
+    for item, email_account, events in batch:
+        sendgrid_events[email_account].extend(events)
+
+    for email_account, events in sendgrid_events.items():
+        process_events(events, email_account)
+
+    for item, email_account, events in batch:
+        event_queue.ack(item)
+
 
 def authenticate_credentials():
     """
     Process Authorization header in HTTP response according to basic HTTP authorization.
 
     Request is stored as Werkzeug local, frappe provides access to headers.
+
+    Returns dict with `email_account` the matched credentials belong to, falsy value when
+    authentication fails.
     """
     received_credentials = frappe.get_request_header("Authorization")
 
@@ -83,14 +270,8 @@ def authenticate_credentials():
             received_credentials))
         return False
 
-    received_credentials = splitted_credentials[1]
-    for credentials in get_webhook_credentials():
-        # matched => authenticated
-        if received_credentials == base64.b64encode(credentials):
-            return True
-
-    # no match => failure
-    return False
+    # matched => authenticated, no match => failure
+    return get_webhook_account(splitted_credentials[1])
 
 
 def set_meta_in_email_body(email):
@@ -98,11 +279,12 @@ def set_meta_in_email_body(email):
     Set X-SMTPAPI header in email to add unique arguments to email message.
 
     Additional argument with message id allows to track this particular message in
-    events from event webhook. Called via app hook make_email_body_message.
+    events from event webhook. Settings of SendGrid Email Account the email is sent from
+    are added too. Called via app hook make_email_body_message.
 
     :param email: Email Account doctype to take message id from
     """
     message_id = email.msg_root.get("Message-Id")
     if message_id:
-        args = {"unique_args": {"message_id": message_id}}
-        email.msg_root[b'X-SMTPAPI'] = json.dumps(args)
+        email.msg_root[b'X-SMTPAPI'] = get_header(message_id,
+                                                 getattr(email, "email_account", None))
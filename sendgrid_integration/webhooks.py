@@ -9,12 +9,21 @@ import random
 import frappe
 from frappe.utils import get_url
 
-from .sendgrid import webhook_exists, add_webhook
-from .account import clear_cache
+from .sendgrid import add_webhook
+from .account import clear_cache, get_webhook_credentials
 
 
 def sync(doc, method=None):
-    """Sync Webhook under SendGrid account."""
+    """
+    Sync Webhook under SendGrid account.
+
+    SendGrid is called by background job `sync_webhook`, so saving Email Account doesn't
+    wait for it. Cache of webhook credentials is cleared only when credentials of the
+    Email Account changed.
+    """
+    if credentials_outdated(doc):
+        clear_cache()
+
     if not doc.service == "SendGrid":
         return
 
@@ -26,37 +35,74 @@ def sync(doc, method=None):
         frappe.msgprint("Imposible to setup SendGrid webhook (incorrect of settings)")
         return
 
-    webhook_url = None
-    if doc.sendgrid_webhook_credentials:
-        webhook_url = get_webhook_post_url(doc.sendgrid_webhook_credentials)
-        if webhook_exists(doc.api_key, webhook_url):
-            frappe.msgprint("SendGrid events webhook already exists")
-            return
+    frappe.enqueue("sendgrid_integration.webhooks.sync_webhook",
+                   email_account=doc.name)
+
+
+def sync_webhook(email_account):
+    """
+    Set up SendGrid events webhook for Email Account unless it is set up already.
+
+    Settings of the webhook are compared with settings of SendGrid cached by API key, so
+    SendGrid is only called when cache expired or settings differ. API key and webhook
+    credentials are read from Email Account, so they are not stored in the job.
+
+    :param email_account: name of Email Account
+    """
+    api_key, credentials = frappe.db.get_value(
+        "Email Account", email_account,
+        ["api_key", "sendgrid_webhook_credentials"]) or (None, None)
+    if not api_key:
+        return
+
+    new_credentials = None
+    if (frappe.conf.sendgrid_webhook_router_url and
+            frappe.conf.sendgrid_webhook_credentials):
+        # sites sharing webhook of the router site authenticate with credentials shared
+        # in common site config
+        if credentials != frappe.conf.sendgrid_webhook_credentials:
+            new_credentials = frappe.conf.sendgrid_webhook_credentials
+    elif not credentials:
+        new_credentials = generate_credentials()
+
+    if not add_webhook(api_key, get_webhook_post_url(new_credentials or credentials)):
+        frappe.errprint("Failed to create SendGrid events webhook for {}".format(
+            email_account))
+        return
 
-    credentials = generate_credentials()
-    webhook_url = get_webhook_post_url(credentials)
-    if add_webhook(doc.api_key, webhook_url):
+    if new_credentials:
         # save webhook credentials in Email Account
-        doc.sendgrid_webhook_credentials = credentials
-        doc.db_set("sendgrid_webhook_credentials", credentials)
+        frappe.db.set_value("Email Account", email_account,
+                            "sendgrid_webhook_credentials", new_credentials,
+                            update_modified=False)
         frappe.db.commit()
+        clear_cache()
 
-        frappe.msgprint("SendGrid events webhook created successfuly")
-    else:
-        frappe.msgprint("Failed to create SendGrid events webhook")
-        frappe.errprint("Failed to create SendGrid events webhook")
 
-    # always clear key cache
-    clear_cache()
+def credentials_outdated(doc):
+    """
+    Check whether cached webhook credentials don't match Email Account.
+
+    :param doc: Email Account
+    """
+    active = (doc.service == "SendGrid" and doc.enable_outgoing and doc.api_key and
+              doc.sendgrid_webhook_credentials)
+    cached = [credentials for credentials, email_account in get_webhook_credentials()
+              if email_account == doc.name]
+
+    return cached != ([doc.sendgrid_webhook_credentials] if active else [])
 
 
 def get_webhook_post_url(webhook_credentials):
     """
     Get Post URL to be called by SendGrid Webhook.
 
+    URL of the site is used unless `sendgrid_webhook_router_url` is set in site config.
+
     :param webhook_credentials: 'username:password' for SendGrid event webhook
     """
-    protocol, hostname = get_url().rsplit("//", 1)
+    protocol, hostname = (frappe.conf.sendgrid_webhook_router_url or
+                          get_url()).rstrip("/").rsplit("//", 1)
     url = "{}//{}@{}".format(protocol, webhook_credentials, hostname)
     return os.path.join(url,
                         "api",